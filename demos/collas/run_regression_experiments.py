@@ -154,8 +154,7 @@ def _eval_metric(
                             evaluate_fn=partial(callbacks.ll_reg,
                                                 scale=obs_scale),
                             label="log_likelihood"),
-            "test": partial(callbacks.cb_reg_discrete_tasks,
-                            scale=obs_scale)
+            "test": callbacks.make_cb_reg_discrete_tasks(scale=obs_scale)
         }
     else: # Non-iid rotations
         if nll_method == "nll":
@@ -6,7 +6,7 @@ import run_main as ev
 from functools import partial
 from cfg_main import get_config
 from rebayes.utils.utils import tree_to_cpu
-from rebayes.utils.callbacks import cb_clf_sup
+from rebayes.utils.callbacks import cb_clf_sup, make_kernel_slices
 from rebayes.sgd_filter import replay_sgd as rsgd
 from rebayes.datasets import rotating_mnist_data as data
 
@@ -78,7 +78,8 @@ if __name__  == "__main__":
 
     ### Lofi---load and train
     agent = ev.load_lofi_agent(cfg, flat_params, emission_mean_fn, emission_cov_fn)
-    callback_lofi = partial(callback_part, recfn=recfn, apply_fn=apply_fn_flat)
+    callback_lofi = partial(callback_part, recfn=recfn, apply_fn=apply_fn_flat,
+                            kernel_slices=make_kernel_slices(recfn, flat_params))
     bel, outputs_lofi = agent.scan(X_train, Y_train, progress_bar=True, callback=callback_lofi)
     bel = jax.block_until_ready(bel)
     outputs_lofi = tree_to_cpu(outputs_lofi)
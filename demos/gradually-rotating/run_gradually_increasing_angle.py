@@ -12,7 +12,7 @@ import run_main as ev
 from functools import partial
 from cfg_main import get_config
 from rebayes.utils.utils import tree_to_cpu
-from rebayes.utils.callbacks import cb_reg_sup
+from rebayes.utils.callbacks import make_cb_reg_sup
 from rebayes.sgd_filter import replay_sgd as rsgd
 from rebayes.datasets import rotating_mnist_data as data
 
@@ -47,10 +47,7 @@ if __name__ == "__main__":
     def emission_cov_fn(w, x): return 0.02
 
     ymean, ystd = data["ymean"], data["ystd"]
-    callback = partial(cb_reg_sup,
-                            X_test=X_train, y_test=Y_train,
-                            ymean=ymean, ystd=ystd,
-                            )
+    callback = make_cb_reg_sup(X_test=X_train, y_test=Y_train, ymean=ymean, ystd=ystd)
 
     callback_lofi = partial(callback, apply_fn=emission_mean_fn)
     callback_rsgd = partial(callback, apply_fn=apply_fn_tree)
@@ -24,6 +24,7 @@ from rebayes.utils.utils import (
     get_mlp_flattened_params
 )
 from rebayes.low_rank_filter.lofi_core import _jacrev_2d
+from rebayes.utils.callbacks import cb_clf_discrete_tasks
 
 TRUNCATED_STD = 20.0 / np.array(.87962566103423978)
 
@@ -226,8 +227,10 @@ def per_batch_callback(i, bel_pre_update, bel, batch, evaluate_fn, **kwargs):
 
 def window_callback_loss(bel, y_pred, t, X, y, bel_pred, loss_fn, nan_val=-1e8, window_size=50, **kwargs):
     X_test, y_test, apply_fn = kwargs["X_test"], kwargs["y_test"], kwargs["apply_fn"]
-    test_idx = jnp.arange(window_size) + t - window_size // 2
-    X_test, y_test = X_test[test_idx], y_test[test_idx]
+    # Clip the start so that early and late windows stay inside the test set
+    start = jnp.clip(t - window_size // 2, 0, X_test.shape[0] - window_size)
+    X_test = jax.lax.dynamic_slice_in_dim(X_test, start, window_size, axis=0)
+    y_test = jax.lax.dynamic_slice_in_dim(y_test, start, window_size, axis=0)
         
     eval = -evaluate_function(bel.mean, apply_fn, X_test, y_test, loss_fn)
     if isinstance(eval, dict):
@@ -240,8 +243,10 @@ def window_callback_loss(bel, y_pred, t, X, y, bel_pred, loss_fn, nan_val=-1e8,
 
 def window_callback_eval(bel, y_pred, t, X, y, bel_pred, evaluate_fn, nan_val=-1e8, window_size=50, **kwargs):
     X_test, y_test, apply_fn = kwargs["X_test"], kwargs["y_test"], kwargs["apply_fn"]
-    test_idx = jnp.arange(window_size) + t - window_size // 2
-    X_test, y_test = X_test[test_idx], y_test[test_idx]
+    # Clip the start so that early and late windows stay inside the test set
+    start = jnp.clip(t - window_size // 2, 0, X_test.shape[0] - window_size)
+    X_test = jax.lax.dynamic_slice_in_dim(X_test, start, window_size, axis=0)
+    y_test = jax.lax.dynamic_slice_in_dim(y_test, start, window_size, axis=0)
         
     eval = evaluate_fn(bel.mean, apply_fn, X_test, y_test)
     if isinstance(eval, dict):
@@ -362,50 +367,11 @@ def rotating_mnist_eval_agent(
 
 def nonstationary_mnist_callback(bel, pred_obs, t, x, y, bel_pred, i, 
                                  nll_loss_fn=None, miscl_loss_fn=None, **kwargs):
-    if nll_loss_fn is None:
-        nll_loss_fn = lambda logits, label: optax.softmax_cross_entropy_with_integer_labels(logits, label).mean()
-    if miscl_loss_fn is None:
-        miscl_loss_fn = lambda logits, label: jnp.mean(logits.argmax(axis=-1) != label)
-    
-    nll_evaluate_fn = partial(
-        evaluate_function,
-        loss_fn=nll_loss_fn,
-    )
-    miscl_evaluate_fn = partial(
-        evaluate_function,
-        loss_fn=miscl_loss_fn,
-    )
-    
-    X_test, y_test, apply_fn = kwargs["X_test"], kwargs["y_test"], kwargs["apply_fn"]
-    ntest_per_batch = kwargs["ntest_per_batch"]
-    
-    prev_test_batch, curr_test_batch = i*ntest_per_batch, (i+1)*ntest_per_batch
-    curr_X_test, curr_y_test = X_test[prev_test_batch:curr_test_batch], y_test[prev_test_batch:curr_test_batch]
-    cum_X_test, cum_y_test = X_test[:curr_test_batch], y_test[:curr_test_batch]
-    
-    overall_nll_result = nll_evaluate_fn(bel.mean, apply_fn, cum_X_test, cum_y_test)
-    current_nll_result = nll_evaluate_fn(bel.mean, apply_fn, curr_X_test, curr_y_test)
-    task1_nll_result = nll_evaluate_fn(bel.mean, apply_fn, X_test[:ntest_per_batch], y_test[:ntest_per_batch])
-        
-    nll_result = {
-        'overall': overall_nll_result,
-        'current': current_nll_result,
-        'task1': task1_nll_result,
-    }
-    
-    overall_miscl_result = miscl_evaluate_fn(bel.mean, apply_fn, cum_X_test, cum_y_test)
-    current_miscl_result = miscl_evaluate_fn(bel.mean, apply_fn, curr_X_test, curr_y_test)
-    task1_miscl_result = miscl_evaluate_fn(bel.mean, apply_fn, X_test[:ntest_per_batch], y_test[:ntest_per_batch])
-    miscl_result = {
-        'overall': overall_miscl_result,
-        'current': current_miscl_result,
-        'task1': task1_miscl_result,
-    }
-    
-    result = {
-        "nll": nll_result,
-        "miscl": miscl_result
-    }
+    # One forward pass over the cumulative test set; the overall, current and
+    # first-task metrics are reductions over it.
+    result = cb_clf_discrete_tasks(bel, pred_obs, t, x, y, bel_pred, i,
+                                   nll_loss_fn=nll_loss_fn,
+                                   miscl_loss_fn=miscl_loss_fn, **kwargs)
     
     return result
 
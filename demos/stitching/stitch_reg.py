@@ -208,7 +208,7 @@ def tune_and_store_hyperparameters(
             callbacks.cb_eval,
             evaluate_fn = lambda w, apply_fn, x, y: \
                 {
-                    "rmse": -jnp.sqrt(jnp.mean((y - vmap(apply_fn, (None, 0))(w, x))**2)),
+                    "rmse": -jnp.sqrt(jnp.mean((y.ravel() - vmap(apply_fn, (None, 0))(w, x).ravel())**2)),
                 }
         )
         optimizer = hparam_tune.create_optimizer(
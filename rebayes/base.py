@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from functools import partial
+import inspect
 from typing import Callable, Union, Tuple, Any
 
 import chex
@@ -24,6 +25,28 @@ EmissionDistFn = Callable[ [Float[Array, "state_dim"], Float[Array, "state_dim s
 CovMat = Union[float, Float[Array, "dim"], Float[Array, "dim dim"]]
 
 
+def _accepts_key_t(callback):
+    """Whether `callback` takes a `key_t` keyword (by name or via **kwargs)."""
+    try:
+        parameters = inspect.signature(callback).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(
+        p.name == "key_t" or p.kind == inspect.Parameter.VAR_KEYWORD
+        for p in parameters
+    )
+
+
+def _split_step_keys(callback, kwargs, num_timesteps):
+    """
+    Per-step callback keys (passed as `key_t`), split once from kwargs["key"].
+    None if there is no key or the callback does not accept `key_t`.
+    """
+    if "key" not in kwargs or callback is None or not _accepts_key_t(callback):
+        return None
+    return jax.random.split(kwargs["key"], num_timesteps)
+
+
 @chex.dataclass
 class Belief:
     mean: Float[Array, "state_dim"]
@@ -87,6 +110,21 @@ class Rebayes(ABC):
         """Return Cov(y(t) | X(t), D(1:t-1))"""
         return None
     
+    @partial(jit, static_argnames=("self", "apply_fn"))
+    def predict_obs_cov_batched(
+        self,
+        bel: Belief,
+        X: Float[Array, "ntime input_dim"],
+        aleatoric_factor: float = 1.0,
+        apply_fn: Callable = None,
+    ) -> Union[Float[Array, "ntime output_dim output_dim"], Any]:
+        """Return Cov(y(t) | X(t), D(1:t-1)) for every row of X.
+        Quantities that only depend on the belief are computed once."""
+        return vmap(
+            lambda x: self.predict_obs_cov(bel, x, aleatoric_factor=aleatoric_factor,
+                                           apply_fn=apply_fn)
+        )(X)
+    
     @partial(jit, static_argnums=(0,))
     def obs_cov(
         self,
@@ -179,6 +217,9 @@ class Rebayes(ABC):
         """
         Compute the negative log predictive density (nlpd) as
         a Monte Carlo estimate.
+        The `n_samples` parameter draws are shared by all points in `x`, so
+        a whole test set should be passed in one call; the result has shape
+        (n_samples, ntime).
         """
         x = jnp.atleast_2d(x)
         y = jnp.atleast_1d(y)
@@ -216,6 +257,7 @@ class Rebayes(ABC):
     ) -> Tuple[Belief, Any]:
         """Apply filtering to entire sequence of data. Return final belief state and outputs from callback."""
         num_timesteps = X.shape[0]
+        step_keys = _split_step_keys(callback, kwargs, num_timesteps)
         def step(bel, t):
             bel_pred = self.update_hyperparams_prepred(bel, X[t], Y[t])
             bel_pred = self.predict_state(bel_pred)
@@ -224,7 +266,8 @@ class Rebayes(ABC):
             bel = self.update_state(bel_pred, X[t], Y[t])
             out = None
             if callback is not None:
-                out = callback(bel, pred_obs, t, X[t], Y[t], bel_pred, **kwargs)
+                cb_kwargs = kwargs if step_keys is None else {**kwargs, "key_t": step_keys[t]}
+                out = callback(bel, pred_obs, t, X[t], Y[t], bel_pred, **cb_kwargs)
             
             return bel, out
         carry = bel
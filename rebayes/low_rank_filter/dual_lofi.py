@@ -184,7 +184,8 @@ def make_dual_lofi_spherical_estimator(
         
         # Inflate posterior covariance.
         m_infl, U_infl, Lambda_infl, eta_infl = \
-            _lofi_spherical_cov_inflate(m0, m, U, Lambda, eta, alpha, inflation)
+            _lofi_spherical_cov_inflate(m0, m, U, Lambda, eta, alpha, inflation,
+                                        orthonormal_basis=True)
         
         # Predict dynamics.
         pp_mean_pred, m_pred, U_pred, Lambda_pred, eta_pred = \
@@ -170,7 +170,8 @@ class RebayesLoFiSpherical(RebayesLoFi):
 
         # Inflate posterior covariance.
         m_infl, U_infl, Lambda_infl, eta_infl = \
-            core._lofi_spherical_cov_inflate(m0, m, U, Lambda, eta, alpha, inflation)
+            core._lofi_spherical_cov_inflate(m0, m, U, Lambda, eta, alpha, inflation,
+                                             orthonormal_basis=self.use_svd)
 
         # Predict dynamics.
         predict_fn = core._lofi_spherical_cov_predict if self.use_svd \
@@ -205,7 +206,8 @@ class RebayesLoFiSpherical(RebayesLoFi):
         else:
             m_Y = lambda z: apply_fn(z, x)
         H = core._jacrev_2d(m_Y, m)
-        G = (Lambda**2) / (eta * (eta + Lambda**2))
+        Lambda_sq = Lambda**2
+        G = Lambda_sq / (eta * (eta + Lambda_sq))
         V_epi = H @ H.T/eta - (G * (H@U)) @ (H@U).T
         R = self.obs_cov(bel, x) * aleatoric_factor
         Sigma_obs = V_epi + R
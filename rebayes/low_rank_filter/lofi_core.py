@@ -1,18 +1,50 @@
-from typing import Tuple, Callable
+from typing import Callable, Sequence, Tuple
 
-from jax import grad, jacrev, jit, vmap
-from jax.lax import scan
+import jax
+from jax import grad, jacrev, jit, vjp, vmap
+from jax.lax import switch
 import jax.numpy as jnp
 import jax.random as jr
+from jax.scipy.linalg import cho_solve
 from jaxtyping import Float, Array
 
 
 # Helper functions -------------------------------------------------------------
 
 _jacrev_2d = lambda f, x: jnp.atleast_2d(jacrev(f)(x))
-_normalize = lambda v: jnp.where(v.any(), v / jnp.linalg.norm(v), jnp.zeros(shape=v.shape))
+_normalize = lambda v: v * jax.lax.rsqrt(jnp.sum(v*v) + 1e-30)
 _vec_pinv = lambda v: jnp.where(v != 0, 1/jnp.array(v), 0) # Vector pseudo-inverse
 
+INFLATION = {
+    'bayesian': 0,
+    'simple': 1,
+    'hybrid': 2,
+}
+_inflation_code = lambda inflation: \
+    INFLATION[inflation] if isinstance(inflation, str) else inflation
+
+
+def _linearize_emission(
+    y_cond_mean: Callable,
+    m: Float[Array, "state_dim"],
+    x: Float[Array, "input_dim"],
+) -> Tuple[Float[Array, "obs_dim"], Float[Array, "obs_dim state_dim"]]:
+    """Evaluate the emission mean and its Jacobian with a single forward pass.
+
+    Args:
+        y_cond_mean (Callable): Conditional emission mean function.
+        m (D_hid,): Linearization point.
+        x (D_in,): Control input.
+
+    Returns:
+        yhat (D_obs,): Emission mean at m.
+        H (D_obs, D_hid): Jacobian of the emission mean at m.
+    """
+    yhat, y_vjp = vjp(lambda w: jnp.atleast_1d(y_cond_mean(w, x)), m)
+    H, = vmap(y_vjp)(jnp.eye(yhat.shape[0], dtype=yhat.dtype))
+    
+    return yhat, H
+
 
 def _invert_2x2_block_matrix(
     M: Float[Array, "m n"],
@@ -35,11 +67,12 @@ def _invert_2x2_block_matrix(
     B = M[:m-lr_block_dim, n-lr_block_dim:]
     D = M[m-lr_block_dim:, n-lr_block_dim:]
     a = 1/jnp.diag(A)
-    K_inv = jnp.linalg.inv(D - (a*B.T) @ B)
+    aBT = a * B.T
+    K_inv = jnp.linalg.inv(D - aBT @ B)
 
-    B_inv = - (a * B.T).T @ K_inv
-    A_inv = jnp.diag(a) + (a * B.T).T @ K_inv @ (a * B.T)
-    C_inv = -K_inv @ (a * B.T)
+    C_inv = -K_inv @ aBT
+    B_inv = C_inv.T
+    A_inv = jnp.diag(a) - aBT.T @ C_inv
     D_inv = K_inv
 
     return jnp.block([[A_inv, B_inv], [C_inv, D_inv]])
@@ -62,7 +95,101 @@ def _fast_svd(
     S = jnp.sqrt(S)
     
     return U, S
+
+
+def _matmul(
+    a: Float[Array, "m k"],
+    b: Float[Array, "k n"],
+    compute_dtype=None,
+) -> Float[Array, "m n"]:
+    """Matrix product, optionally with inputs cast to a lower-precision
+    compute dtype while accumulating in the input precision.
+
+    Args:
+        a (m, k): Left matrix.
+        b (k, n): Right matrix.
+        compute_dtype (dtype, optional): Dtype of the multiplied inputs.
+
+    Returns:
+        (m, n): Matrix product.
+    """
+    if compute_dtype is None:
+        return a @ b
+    
+    return jnp.matmul(
+        a.astype(compute_dtype), b.astype(compute_dtype),
+        preferred_element_type=jnp.result_type(a, b)
+    )
+
+
+def _block_gram(
+    Ms: Sequence[Float[Array, "m _"]],
+    Ns: Sequence[Float[Array, "m _"]] = None,
+    compute_dtype=None,
+) -> Float[Array, "k l"]:
+    """Compute [M_1, ..., M_a].T @ [N_1, ..., N_b] without stacking the blocks.
+
+    Args:
+        Ms: Column blocks of the left matrix.
+        Ns: Column blocks of the right matrix. Defaults to Ms.
+        compute_dtype (dtype, optional): Dtype of the multiplied inputs.
+
+    Returns:
+        (k, l): Gram matrix.
+    """
+    Ns = Ms if Ns is None else Ns
     
+    return jnp.block([[_matmul(Mi.T, Nj, compute_dtype) for Nj in Ns] for Mi in Ms])
+
+
+def _block_matmul(
+    Ms: Sequence[Float[Array, "m _"]],
+    B: Float[Array, "k n"],
+    compute_dtype=None,
+) -> Float[Array, "m n"]:
+    """Compute [M_1, ..., M_a] @ B without stacking the blocks.
+
+    Args:
+        Ms: Column blocks of the left matrix.
+        B (k, n): Right matrix.
+        compute_dtype (dtype, optional): Dtype of the multiplied inputs.
+
+    Returns:
+        (m, n): Matrix product.
+    """
+    result, start = 0.0, 0
+    for M in Ms:
+        k = M.shape[1]
+        result = result + _matmul(M, B[start:start+k], compute_dtype)
+        start += k
+    
+    return result
+
+
+def _fast_svd_blocks(
+    Ms: Sequence[Float[Array, "m _"]],
+    compute_dtype=None,
+) -> Tuple[Float[Array, "m k"], Float[Array, "k"]]:
+    """Singular value decomposition of the horizontally stacked blocks
+    [M_1, ..., M_a], computed from their block-wise Gram matrix.
+
+    Args:
+        Ms: Column blocks of the matrix to decompose.
+        compute_dtype (dtype, optional): Dtype of the multiplied inputs.
+
+    Returns:
+        U (m, k): Left singular vectors.
+        S (k,): Singular values.
+        S_sq (k,): Squared singular values, i.e. eigenvalues of the Gram matrix.
+    """
+    U, S_sq, _ = jnp.linalg.svd(
+        _block_gram(Ms, compute_dtype=compute_dtype), full_matrices = False, hermitian = True
+    )
+    S = jnp.sqrt(S_sq)
+    U = _block_matmul(Ms, U * _vec_pinv(S), compute_dtype)
+    
+    return U, S, S_sq
+
 
 
 # Common inference functions ---------------------------------------------------
@@ -95,8 +222,7 @@ def _lofi_estimate_noise(
     if not adaptive_variance:
         return nobs_est, 0.0
 
-    m_Y = lambda w: y_cond_mean(w, x)
-    yhat = jnp.atleast_1d(m_Y(m))
+    yhat = jnp.atleast_1d(y_cond_mean(m, x))
     
     sqerr = ((yhat - y).T @ (yhat - y)).squeeze() / yhat.shape[0]
     obs_noise_var_est = jnp.max(jnp.array([1e-6, obs_noise_var + 1/nobs_est * (sqerr - obs_noise_var)]))
@@ -113,7 +239,8 @@ def _lofi_spherical_cov_inflate(
     Lambda: Float[Array, "memory_size"],
     eta: float,
     alpha: float,
-    inflation: str = "bayesian"
+    inflation: str = "bayesian",
+    orthonormal_basis: bool = False,
 ):
     """Inflate the spherical posterior covariance matrix.
 
@@ -124,7 +251,11 @@ def _lofi_spherical_cov_inflate(
         Lambda (D_mem,): Prior signular values.
         eta (float): Prior precision.
         alpha (float): Covariance inflation factor.
-        inflation (str, optional): Type of inflation. Defaults to 'bayesian'.
+        inflation (str or int, optional): Type of inflation, either a key
+            of INFLATION or its integer code. Defaults to 'bayesian'.
+        orthonormal_basis (bool, optional): Whether U has orthonormal columns
+            (as after an SVD update); the SVD-free updates only guarantee
+            unit-norm columns. Defaults to False.
 
     Returns:
         m_infl (D_hid,): Post-inflation mean.
@@ -134,20 +265,35 @@ def _lofi_spherical_cov_inflate(
     """    
     Lambda_infl = Lambda / jnp.sqrt(1+alpha)
     U_infl = U
-    W_infl = U_infl * Lambda_infl
+    eta = jnp.asarray(eta, dtype=m.dtype)
     
-    if inflation == 'bayesian':
+    def _bayesian_inflate(eta):
         eta_infl = eta
-        G = jnp.linalg.pinv(jnp.eye(W_infl.shape[1]) +  (W_infl.T @ (W_infl/eta_infl)))
         e = (m0 - m)
-        K = e - ((W_infl/eta_infl) @ G) @ (W_infl.T @ e)
+        if orthonormal_basis:
+            # I + W^T W / eta is diagonal, so its inverse is elementwise.
+            Lambda_sq = Lambda_infl**2
+            G_diag = 1.0 / (1.0 + Lambda_sq/eta_infl)
+            K = e - U_infl @ ((Lambda_sq * G_diag / eta_infl) * (U_infl.T @ e))
+        else:
+            W_infl = U_infl * Lambda_infl
+            G = jnp.linalg.pinv(jnp.eye(W_infl.shape[1]) + (W_infl.T @ (W_infl/eta_infl)))
+            K = e - ((W_infl/eta_infl) @ G) @ (W_infl.T @ e)
         m_infl = m + alpha/(1+alpha) * K.ravel()
-    elif inflation == 'simple':
-        eta_infl = eta/(1+alpha)
-        m_infl = m
-    elif inflation == 'hybrid':
-        eta_infl = eta
-        m_infl = m
+        
+        return m_infl, eta_infl
+    
+    def _simple_inflate(eta):
+        return m, eta/(1+alpha)
+    
+    def _hybrid_inflate(eta):
+        return m, eta
+    
+    m_infl, eta_infl = switch(
+        _inflation_code(inflation),
+        [_bayesian_inflate, _simple_inflate, _hybrid_inflate],
+        eta,
+    )
     
     return m_infl, U_infl, Lambda_infl, eta_infl
 
@@ -188,19 +334,15 @@ def _lofi_spherical_cov_predict(
 
     # Covariance prediction
     U_pred = U
+    Lambda_sq = Lambda**2
     
     if steady_state:
         eta_pred = eta
-        Lambda_pred = jnp.sqrt(
-            (gamma**2 * Lambda**2) /
-            (1 + q*Lambda**2)
-        )
+        Lambda_pred = jnp.abs(gamma) * Lambda * jax.lax.rsqrt(1 + q*Lambda_sq)
     else:
-        eta_pred = eta/(gamma**2 + q*eta)
-        Lambda_pred = jnp.sqrt(
-            (gamma**2 * Lambda**2) /
-            ((gamma**2 + q*eta) * (gamma**2 + q*eta + q*Lambda**2))
-        )
+        denom = gamma**2 + q*eta
+        eta_pred = eta/denom
+        Lambda_pred = jnp.abs(gamma) * Lambda * jax.lax.rsqrt(denom * (denom + q*Lambda_sq))
 
     return m0_pred, m_pred, U_pred, Lambda_pred, eta_pred
 
@@ -284,26 +426,23 @@ def _lofi_spherical_cov_condition_on(
         Lambda_cond (D_mem,): Posterior singular values.
     """
     P, L = U.shape
-    m_Y = lambda w: y_cond_mean(w, x)
-    Cov_Y = lambda w: y_cond_cov(w, x)
-    
-    yhat = jnp.atleast_1d(m_Y(m))
+    yhat, H = _linearize_emission(y_cond_mean, m, x)
     C = yhat.shape[0]
     
     if adaptive_variance:
         R = jnp.eye(C) * obs_noise_var
     else:
-        R = jnp.atleast_2d(Cov_Y(m))
+        R = jnp.atleast_2d(y_cond_cov(m, x))
     R_chol = jnp.linalg.cholesky(R)
     A = jnp.linalg.lstsq(R_chol, jnp.eye(C))[0].T
-    H = _jacrev_2d(m_Y, m)
-    W_tilde = jnp.hstack([Lambda * U, (H.T @ A).reshape(P, -1)])
+    HA = H.T @ A
+    HAAT = HA @ A.T
 
     # Update the U matrix
-    u, lamb = _fast_svd(W_tilde)
+    u, lamb, lamb_sq = _fast_svd_blocks([Lambda * U, HA.reshape(P, -1)])
 
-    D = (lamb**2)/(eta**2 + eta * lamb**2)
-    K = (H.T @ A) @ A.T/eta - (D * u) @ (u.T @ ((H.T @ A) @ A.T))
+    D = lamb_sq/(eta**2 + eta * lamb_sq)
+    K = HAAT/eta - (D * u) @ (u.T @ HAAT)
 
     U_cond = u[:, :L]
     Lambda_cond = lamb[:L]
@@ -345,27 +484,27 @@ def _lofi_spherical_cov_svd_free_condition_on(
         Lambda_cond (D_mem,): Posterior singular values.
     """
     P, L = U.shape
-    m_Y = lambda w: y_cond_mean(w, x)
-    Cov_Y = lambda w: y_cond_cov(w, x)
-    
-    yhat = jnp.atleast_1d(m_Y(m))
+    yhat, H = _linearize_emission(y_cond_mean, m, x)
     C = yhat.shape[0]
     
     if adaptive_variance:
         R = jnp.eye(C) * obs_noise_var
     else:
-        R = jnp.atleast_2d(Cov_Y(m))
+        R = jnp.atleast_2d(y_cond_cov(m, x))
     R_chol = jnp.linalg.cholesky(R)
     A = jnp.linalg.lstsq(R_chol, jnp.eye(C))[0].T
-    H = _jacrev_2d(m_Y, m)
     AH = A.T @ H
     
-    Lambda_plus = jnp.sqrt(jnp.einsum("ij,ij->i", AH, AH))
+    Lambda_plus_sq = jnp.einsum("ij,ij->i", AH, AH)
+    Lambda_plus = jnp.sqrt(Lambda_plus_sq)
     Lambda_tilde = jnp.hstack([Lambda, Lambda_plus])
+    Lambda_tilde_sq = jnp.hstack([Lambda**2, Lambda_plus_sq])
     U_tilde = jnp.hstack([U, AH.T/Lambda_plus])
 
-    G = jnp.linalg.pinv(jnp.diag(eta/(Lambda_tilde**2)) + U_tilde.T @ U_tilde)
-    K = (H.T @ A) @ A.T/eta - ((U_tilde/eta) @ G) @ ((U_tilde/eta).T @ (H.T @ A) @ A.T)
+    HAAT = AH.T @ A.T
+    U_scaled = U_tilde * (1/eta)
+    G = jnp.linalg.pinv(jnp.diag(eta/Lambda_tilde_sq) + U_tilde.T @ U_tilde)
+    K = HAAT/eta - (U_scaled @ G) @ (U_scaled.T @ HAAT)
     m_cond = m + K @ (y - yhat)
     
     sorted_order = jnp.argsort(-jnp.abs(Lambda_tilde))
@@ -397,7 +536,8 @@ def _lofi_diagonal_cov_inflate(
         eta (float): Prior precision.
         Ups (D_hid,): Prior diagonal covariance.
         alpha (float): Covariance inflation factor.
-        inflation (str, optional): Type of inflation. Defaults to 'bayesian'.
+        inflation (str or int, optional): Type of inflation, either a key
+            of INFLATION or its integer code. Defaults to 'bayesian'.
 
     Returns:
         m_infl (D_hid,): Post-inflation mean.
@@ -407,22 +547,29 @@ def _lofi_diagonal_cov_inflate(
     """
     P, L = U.shape
     W = U * Lambda
+    W_infl = W/jnp.sqrt(1+alpha)
     
-    if inflation == 'bayesian':
-        W_infl = W/jnp.sqrt(1+alpha)
+    def _bayesian_inflate(Ups):
         Ups_infl = Ups/(1+alpha) + alpha*eta/(1+alpha)
-        G = jnp.linalg.pinv(jnp.eye(L) +  (W_infl.T @ (W_infl/Ups_infl)))
+        W_scaled = W_infl/Ups_infl
+        G = jnp.linalg.pinv(jnp.eye(L) +  (W_infl.T @ W_scaled))
         e = (m0 - m)
-        K = 1/Ups_infl.ravel() * (e - (W_infl @ G) @ ((W_infl/Ups_infl).T @ e))
+        K = 1/Ups_infl.ravel() * (e - (W_infl @ G) @ (W_scaled.T @ e))
         m_infl = m + alpha*eta/(1+alpha) * K
-    elif inflation == 'simple':
-        W_infl = W/jnp.sqrt(1+alpha)
-        Ups_infl = Ups/(1+alpha)
-        m_infl = m
-    elif inflation == 'hybrid':
-        W_infl = W/jnp.sqrt(1+alpha)
-        Ups_infl = Ups/(1+alpha) + alpha*eta/(1+alpha)
-        m_infl = m
+        
+        return m_infl, Ups_infl
+    
+    def _simple_inflate(Ups):
+        return m, Ups/(1+alpha)
+    
+    def _hybrid_inflate(Ups):
+        return m, Ups/(1+alpha) + alpha*eta/(1+alpha)
+    
+    m_infl, Ups_infl = switch(
+        _inflation_code(inflation),
+        [_bayesian_inflate, _simple_inflate, _hybrid_inflate],
+        Ups,
+    )
     U_infl, Lambda_infl = W_infl, jnp.ones(L)
     
     return  m_infl, U_infl, Lambda_infl, Ups_infl
@@ -562,31 +709,29 @@ def _lofi_diagonal_cov_condition_on(
         Ups_cond (D_hid,): Posterior precision.
     """
     P, L = U.shape
-    m_Y = lambda w: y_cond_mean(w, x)
-    Cov_Y = lambda w: y_cond_cov(w, x)
-    
-    H = _jacrev_2d(m_Y, m)
-    yhat = jnp.atleast_1d(m_Y(m))
+    yhat, H = _linearize_emission(y_cond_mean, m, x)
     C = yhat.shape[0]
     
     if adaptive_variance:
         R = jnp.eye(C) * obs_noise_var
     else:
-        R = jnp.atleast_2d(Cov_Y(m))
+        R = jnp.atleast_2d(y_cond_cov(m, x))
     R_chol = jnp.linalg.cholesky(R)
     A = jnp.linalg.lstsq(R_chol, jnp.eye(C))[0].T
-    W_tilde = jnp.hstack([Lambda * U, (H.T @ A).reshape(P, -1)])
+    HA = H.T @ A
+    HAAT = HA @ A.T
+    W_blocks = [Lambda * U, HA.reshape(P, -1)]
     
     # Update the U matrix
-    u, lamb = _fast_svd(W_tilde)
+    u, lamb, lamb_sq = _fast_svd_blocks(W_blocks)
     
     U_cond, U_extra = u[:, :L], u[:, L:]
-    Lambda_cond, Lambda_extra = lamb[:L], lamb[L:]
-    W_extra = Lambda_extra * U_extra
-    Ups_cond = Ups + jnp.einsum('ij,ij->i', W_extra, W_extra)[:, jnp.newaxis]
+    Lambda_cond = lamb[:L]
+    Ups_cond = Ups + ((U_extra**2) @ lamb_sq[L:])[:, jnp.newaxis]
     
-    G = jnp.linalg.pinv(jnp.eye(W_tilde.shape[1]) + W_tilde.T @ (W_tilde/Ups))
-    K = (H.T @ A) @ A.T/Ups - (W_tilde/Ups @ G) @ ((W_tilde/Ups).T @ (H.T @ A) @ A.T)
+    W_scaled = [W/Ups for W in W_blocks]
+    G = jnp.linalg.pinv(jnp.eye(L + C) + _block_gram(W_blocks, W_scaled))
+    K = HAAT/Ups - _block_matmul(W_scaled, G @ _block_gram(W_scaled, [HAAT]))
     m_cond = m + K @ (y - yhat)
     
     return m_cond, U_cond, Lambda_cond, Ups_cond
@@ -625,34 +770,33 @@ def _lofi_diagonal_cov_svd_free_condition_on(
         Ups_cond (D_hid,): Posterior precision.
     """
     P, L = U.shape
-    m_Y = lambda w: y_cond_mean(w, x)
-    Cov_Y = lambda w: y_cond_cov(w, x)
-    
-    H = _jacrev_2d(m_Y, m)
-    yhat = jnp.atleast_1d(m_Y(m))
+    yhat, H = _linearize_emission(y_cond_mean, m, x)
     C = yhat.shape[0]
     
     if adaptive_variance:
         R = jnp.eye(C) * obs_noise_var
     else:
-        R = jnp.atleast_2d(Cov_Y(m))
+        R = jnp.atleast_2d(y_cond_cov(m, x))
     R_chol = jnp.linalg.cholesky(R)
     A = jnp.linalg.lstsq(R_chol, jnp.eye(C))[0].T
     AH = A.T @ H
     
-    Lambda_plus = jnp.sqrt(jnp.einsum("ij,ij->i", AH/Ups.T, AH))
+    Lambda_plus_sq = jnp.einsum("ij,ij->i", AH/Ups.T, AH)
+    Lambda_plus = jnp.sqrt(Lambda_plus_sq)
     Lambda_tilde = jnp.hstack([Lambda, Lambda_plus])
+    Lambda_tilde_sq = jnp.hstack([Lambda**2, Lambda_plus_sq])
     U_tilde = jnp.hstack([U, AH.T/Lambda_plus])
     
-    G = jnp.linalg.pinv(jnp.diag(1/(Lambda_tilde**2)) + U_tilde.T @ (U_tilde/Ups))
-    K = (H.T @ A) @ A.T/Ups - ((U_tilde/Ups) @ G) @ ((U_tilde/Ups).T @ (H.T @ A) @ A.T)
+    HAAT = AH.T @ A.T
+    U_scaled = U_tilde/Ups
+    G = jnp.linalg.pinv(jnp.diag(1/Lambda_tilde_sq) + U_tilde.T @ U_scaled)
+    K = HAAT/Ups - (U_scaled @ G) @ (U_scaled.T @ HAAT)
     m_cond = m + K @ (y - yhat)
     
     sorted_order = jnp.argsort(-jnp.abs(Lambda_tilde))
     U_cond, U_extra = U_tilde[:, sorted_order[:L]], U_tilde[:, sorted_order[L:]]
-    Lambda_cond, Lambda_extra = Lambda_tilde[sorted_order[:L]], Lambda_tilde[sorted_order[L:]]
-    W_extra = Lambda_extra * U_extra
-    Ups_cond = Ups + jnp.einsum("ij,ij->i", W_extra, W_extra)[:, jnp.newaxis]
+    Lambda_cond = Lambda_tilde[sorted_order[:L]]
+    Ups_cond = Ups + ((U_extra**2) @ Lambda_tilde_sq[sorted_order[L:]])[:, jnp.newaxis]
     
     return m_cond, U_cond, Lambda_cond, Ups_cond
 
@@ -669,6 +813,8 @@ def _replay_lofi_diagonal_cov_condition_on(
     y: Float[Array, "obs_dim"],
     adaptive_variance: bool = False,
     obs_noise_var: float = 1.0,
+    lin: Tuple[Float[Array, "obs_dim"], Float[Array, "obs_dim state_dim"]] = None,
+    compute_dtype=None,
 ):
     """Condition step of the low-rank filter with diagonal covariance matrix.
 
@@ -684,6 +830,10 @@ def _replay_lofi_diagonal_cov_condition_on(
         y (D_obs,): Emission.
         adaptive_variance (bool): Whether to use adaptive variance.
         obs_noise_var (float): Observation noise variance.
+        lin (tuple, optional): Precomputed linearization (yhat_lin, H) of
+            the emission at m_lin. Computed here if None.
+        compute_dtype (dtype, optional): Dtype of the inputs to the
+            (D_hid, D_mem) matrix products. Defaults to their own dtype.
 
     Returns:
         m_cond (D_hid,): Posterior mean.
@@ -692,32 +842,34 @@ def _replay_lofi_diagonal_cov_condition_on(
         Ups_cond (D_hid,): Posterior precision.
     """
     P, L = U.shape
-    m_Y = lambda w: y_cond_mean(w, x)
-    Cov_Y = lambda w: y_cond_cov(w, w, x)
-    
-    H = _jacrev_2d(m_Y, m_lin)
-    # yhat = jnp.atleast_1d(m_Y(m_lin)) + H @ (m - m_lin)
-    yhat = jnp.atleast_1d(m_Y(m))
+    _, H = _linearize_emission(y_cond_mean, m_lin, x) if lin is None else lin
+    # yhat = yhat_lin + H @ (m - m_lin)
+    yhat = jnp.atleast_1d(y_cond_mean(m, x))
     C = yhat.shape[0]
     
     if adaptive_variance:
         R = jnp.eye(C) * obs_noise_var
     else:
-        R = jnp.atleast_2d(Cov_Y(m))
+        R = jnp.atleast_2d(y_cond_cov(m, m, x))
     R_chol = jnp.linalg.cholesky(R)
     A = jnp.linalg.lstsq(R_chol, jnp.eye(C))[0].T
-    W_tilde = jnp.hstack([Lambda * U, (H.T @ A).reshape(P, -1)])
+    HA = H.T @ A
+    HAAT = HA @ A.T
+    W_blocks = [Lambda * U, HA.reshape(P, -1)]
     
     # Update the U matrix
-    u, lamb = _fast_svd(W_tilde)
+    u, lamb, lamb_sq = _fast_svd_blocks(W_blocks, compute_dtype)
     
     U_cond, U_extra = u[:, :L], u[:, L:]
-    Lambda_cond, Lambda_extra = lamb[:L], lamb[L:]
-    W_extra = Lambda_extra * U_extra
-    Ups_cond = Ups + jnp.einsum('ij,ij->i', W_extra, W_extra)[:, jnp.newaxis]
+    Lambda_cond = lamb[:L]
+    Ups_cond = Ups + ((U_extra**2) @ lamb_sq[L:])[:, jnp.newaxis]
     
-    G = jnp.linalg.pinv(jnp.eye(W_tilde.shape[1]) + W_tilde.T @ (W_tilde/Ups))
-    K = (H.T @ A) @ A.T/Ups - (W_tilde/Ups @ G) @ ((W_tilde/Ups).T @ (H.T @ A) @ A.T)
+    W_scaled = [W/Ups for W in W_blocks]
+    G_chol = jnp.linalg.cholesky(jnp.eye(L + C) + _block_gram(W_blocks, W_scaled, compute_dtype))
+    K = HAAT/Ups - _block_matmul(
+        W_scaled, cho_solve((G_chol, True), _block_gram(W_scaled, [HAAT], compute_dtype)),
+        compute_dtype
+    )
     m_cond = m + K @ (y - yhat)
     
     return m_cond, U_cond, Lambda_cond, Ups_cond
@@ -735,6 +887,8 @@ def _replay_lofi_diagonal_cov_svd_free_condition_on(
     y: Float[Array, "obs_dim"],
     adaptive_variance: bool = False,
     obs_noise_var: float = 1.0,
+    lin: Tuple[Float[Array, "obs_dim"], Float[Array, "obs_dim state_dim"]] = None,
+    compute_dtype=None,
 ):
     """Condition step of the SVD-free low-rank filter with diagonal covariance matrix.
 
@@ -749,6 +903,10 @@ def _replay_lofi_diagonal_cov_svd_free_condition_on(
         y (D_obs,): Emission.
         adaptive_variance (bool): Whether to use adaptive variance.
         obs_noise_var (float): Observation noise variance.
+        lin (tuple, optional): Precomputed linearization (yhat_lin, H) of
+            the emission at m_lin. Computed here if None.
+        compute_dtype (dtype, optional): Dtype of the inputs to the
+            (D_hid, D_mem) matrix products. Defaults to their own dtype.
 
     Returns:
         m_cond (D_hid,): Posterior mean.
@@ -757,34 +915,123 @@ def _replay_lofi_diagonal_cov_svd_free_condition_on(
         Ups_cond (D_hid,): Posterior precision.
     """
     P, L = U.shape
-    m_Y = lambda w: y_cond_mean(w, x)
-    Cov_Y = lambda w: y_cond_cov(w, m_lin, x)
-    
-    H = _jacrev_2d(m_Y, m_lin)
-    yhat = jnp.atleast_1d(m_Y(m_lin)) + H @ (m - m_lin)
+    yhat_lin, H = _linearize_emission(y_cond_mean, m_lin, x) if lin is None else lin
+    yhat = yhat_lin + H @ (m - m_lin)
     C = yhat.shape[0]
     
     if adaptive_variance:
         R = jnp.eye(C) * obs_noise_var
     else:
-        R = jnp.atleast_2d(Cov_Y(m))
+        R = jnp.atleast_2d(y_cond_cov(m, m_lin, x))
     R_chol = jnp.linalg.cholesky(R)
     A = jnp.linalg.lstsq(R_chol, jnp.eye(C))[0].T
     AH = A.T @ H
     
-    Lambda_plus = jnp.sqrt(jnp.einsum("ij,ij->i", AH/Ups.T, AH))
+    Lambda_plus_sq = jnp.einsum("ij,ij->i", AH/Ups.T, AH)
+    Lambda_plus = jnp.sqrt(Lambda_plus_sq)
     Lambda_tilde = jnp.hstack([Lambda, Lambda_plus])
+    Lambda_tilde_sq = jnp.hstack([Lambda**2, Lambda_plus_sq])
     U_tilde = jnp.hstack([U, AH.T/Lambda_plus])
     
-    G = jnp.linalg.pinv(jnp.diag(1/(Lambda_tilde**2)) + U_tilde.T @ (U_tilde/Ups))
-    K = (H.T @ A) @ A.T/Ups - ((U_tilde/Ups) @ G) @ ((U_tilde/Ups).T @ (H.T @ A) @ A.T)
+    # Woodbury update through the SPD (L+C, L+C) matrix I + W^T W/Ups
+    HAAT = AH.T @ A.T
+    W_blocks = [Lambda * U, AH.T]
+    W_scaled = [W/Ups for W in W_blocks]
+    G_chol = jnp.linalg.cholesky(jnp.eye(L + C) + _block_gram(W_blocks, W_scaled, compute_dtype))
+    K = HAAT/Ups - _block_matmul(
+        W_scaled, cho_solve((G_chol, True), _block_gram(W_scaled, [HAAT], compute_dtype)),
+        compute_dtype
+    )
     m_cond = m + K @ (y - yhat)
     
     sorted_order = jnp.argsort(-jnp.abs(Lambda_tilde))
     U_cond, U_extra = U_tilde[:, sorted_order[:L]], U_tilde[:, sorted_order[L:]]
-    Lambda_cond, Lambda_extra = Lambda_tilde[sorted_order[:L]], Lambda_tilde[sorted_order[L:]]
-    W_extra = Lambda_extra * U_extra
-    Ups_cond = Ups + jnp.einsum("ij,ij->i", W_extra, W_extra)[:, jnp.newaxis]
+    Lambda_cond = Lambda_tilde[sorted_order[:L]]
+    Ups_cond = Ups + ((U_extra**2) @ Lambda_tilde_sq[sorted_order[L:]])[:, jnp.newaxis]
+    
+    return m_cond, U_cond, Lambda_cond, Ups_cond
+
+
+def _replay_lofi_diagonal_cov_batch_condition_on(
+    m: Float[Array, "state_dim"],
+    m_lin: Float[Array, "state_dim"],
+    U: Float[Array, "state_dim memory_size"],
+    Lambda: Float[Array, "memory_size"],
+    Ups: Float[Array, "state_dim"],
+    y_cond_mean: Callable,
+    y_cond_cov: Callable,
+    X: Float[Array, "buffer_size input_dim"],
+    Y: Float[Array, "buffer_size obs_dim"],
+    adaptive_variance: bool = False,
+    obs_noise_var: float = 1.0,
+    lin: Tuple[Float[Array, "buffer_size obs_dim"], 
+               Float[Array, "buffer_size obs_dim state_dim"]] = None,
+    compute_dtype=None,
+):
+    """Condition step of the low-rank filter with diagonal covariance matrix
+    on a whole buffer of emissions at once, linearized at m_lin.
+    
+    The information contributed by each emission adds up, and in low-rank
+    form that sum is the column concatenation of the H_t.T @ A_t blocks,
+    so the buffer is absorbed with a single Woodbury solve.
+
+    Args:
+        m (D_hid,): Prior mean.
+        m_lin (D_hid,): Linearization point for mean.
+        U (D_hid, D_mem,): Prior basis.
+        Lambda (D_mem,): Prior singular values.
+        Ups (D_hid): Prior precision. 
+        y_cond_mean (Callable): Conditional emission mean function.
+        y_cond_cov (Callable): Conditional emission covariance function.
+        X (D_buf, D_in,): Control inputs.
+        Y (D_buf, D_obs,): Emissions.
+        adaptive_variance (bool): Whether to use adaptive variance.
+        obs_noise_var (float): Observation noise variance.
+        lin (tuple, optional): Precomputed linearizations (yhat_lin, H) of
+            the emission at m_lin for every input. Computed here if None.
+        compute_dtype (dtype, optional): Dtype of the inputs to the
+            (D_hid, D_mem) matrix products. Defaults to their own dtype.
+
+    Returns:
+        m_cond (D_hid,): Posterior mean.
+        U_cond (D_hid, D_mem,): Posterior basis.
+        Lambda_cond (D_mem,): Posterior singular values.
+        Ups_cond (D_hid,): Posterior precision.
+    """
+    P, L = U.shape
+    if lin is None:
+        lin = vmap(_linearize_emission, (None, None, 0))(y_cond_mean, m_lin, X)
+    yhat_lin, H = lin
+    yhat = yhat_lin + H @ (m - m_lin)
+    T, C = yhat.shape
+    
+    if adaptive_variance:
+        R = jnp.broadcast_to(jnp.eye(C) * obs_noise_var, (T, C, C))
+    else:
+        R = vmap(lambda x: jnp.atleast_2d(y_cond_cov(m, m_lin, x)))(X)
+    R_chol = jnp.linalg.cholesky(R)
+    A = vmap(lambda R_chol: jnp.linalg.lstsq(R_chol, jnp.eye(C))[0].T)(R_chol)
+    HA = jnp.einsum("tcp,tcd->ptd", H, A).reshape(P, -1)
+    z = jnp.einsum("tcd,tc->td", A, Y.reshape(T, C) - yhat).ravel()
+    W_blocks = [Lambda * U, HA]
+    
+    # Update the U matrix
+    u, lamb, lamb_sq = _fast_svd_blocks(W_blocks, compute_dtype)
+    
+    U_cond, U_extra = u[:, :L], u[:, L:]
+    Lambda_cond = lamb[:L]
+    Ups_cond = Ups + ((U_extra**2) @ lamb_sq[L:])[:, jnp.newaxis]
+    
+    # Woodbury solve against the information vector sum_t H_t.T R_t^-1 r_t
+    g = (HA @ z)[:, jnp.newaxis]
+    W_scaled = [W/Ups for W in W_blocks]
+    G_chol = jnp.linalg.cholesky(jnp.eye(L + T*C) + _block_gram(W_blocks, W_scaled, compute_dtype))
+    m_cond = m + (
+        g/Ups - _block_matmul(
+            W_scaled, cho_solve((G_chol, True), _block_gram(W_scaled, [g], compute_dtype)),
+            compute_dtype
+        )
+    ).ravel()
     
     return m_cond, U_cond, Lambda_cond, Ups_cond
 
@@ -817,50 +1064,41 @@ def _lofi_orth_condition_on(
         y (D_obs,): Emission.
         adaptive_variance (bool): Whether to use adaptive variance.
         obs_noise_var (float): Observation noise variance.
-        key (int): Random key.
+        key (int): Unused; kept for backward compatibility.
 
     Returns:
         m_cond (D_hid,): Posterior mean.
         U_cond (D_hid, D_mem,): Posterior basis.
         Lambda_cond (D_mem,): Posterior singular values.
     """
-    if isinstance(key, int) or len(key.shape) < 1:
-        key = jr.PRNGKey(key)
     P, L = U.shape
     
-    m_Y = lambda w: y_cond_mean(w, x)
-    Cov_Y = lambda w: y_cond_cov(w, x)
-
-    yhat = jnp.atleast_1d(m_Y(m))    
+    yhat, H = _linearize_emission(y_cond_mean, m, x)
     C = yhat.shape[0]
     
     if adaptive_variance:
         R = jnp.eye(C) * obs_noise_var
     else:
-        R = jnp.atleast_2d(Cov_Y(m))
+        R = jnp.atleast_2d(y_cond_cov(m, x))
     R_chol = jnp.linalg.cholesky(R)
     A = jnp.linalg.lstsq(R_chol, jnp.eye(C))[0].T
-    H = _jacrev_2d(m_Y, m)
-    W_tilde = jnp.hstack([Lambda * U, (H.T @ A).reshape(P, -1)])
-    S = eta*jnp.eye(W_tilde.shape[1]) + W_tilde.T @ W_tilde
-    K = (H.T @ A) @ A.T - W_tilde @ (_invert_2x2_block_matrix(S, C) @ (W_tilde.T @ ((H.T @ A) @ A.T)))
-
-    # Update the basis and singular values
-    def _update_basis(carry, i):
-        U, Lambda = carry
-        U_tilde = (H.T - U @ (U.T @ H.T)) @ A
-        v = U_tilde[:, i]
-        u = _normalize(v)
-        U_cond = jnp.where(Lambda.min() < u @ v, U.at[:, Lambda.argmin()].set(u), U)
-        Lambda_cond = jnp.where(Lambda.min() < u @ v, Lambda.at[Lambda.argmin()].set(u.T @ v), Lambda)
-        
-        return (U_cond, Lambda_cond), (U_cond, Lambda_cond)
-
-    perm = jr.permutation(key, C)
-    (U_cond, Lambda_cond), _ = scan(_update_basis, (U, Lambda), perm)
+    HA = H.T @ A
+    HAAT = HA @ A.T
+    W_blocks = [Lambda * U, HA.reshape(P, -1)]
+    S = eta*jnp.eye(L + C) + _block_gram(W_blocks)
+    K = HAAT - _block_matmul(W_blocks, _invert_2x2_block_matrix(S, C) @ _block_gram(W_blocks, [HAAT]))
+
+    # Update the basis and singular values: orthonormalize the deflated
+    # directions in one QR and keep the L largest singular values overall
+    U_tilde = (H.T - U @ (U.T @ H.T)) @ A
+    Q_new, R_new = jnp.linalg.qr(U_tilde)
+    Lambda_all = jnp.concatenate([Lambda, jnp.abs(jnp.diag(R_new))])
+    U_all = jnp.concatenate([U, Q_new], axis=1)
+    top = jnp.argsort(-Lambda_all)[:L]
+    U_cond, Lambda_cond = U_all[:, top], Lambda_all[top]
     
     # Update the mean
-    m_cond = m + K/eta @ (y - yhat)
+    m_cond = m + (K @ (y - yhat))/eta
 
     return m_cond, U_cond, Lambda_cond
 
@@ -959,11 +1197,9 @@ def _lofi_diagonal_gradient_resample_condition_on(
         key = jr.PRNGKey(key)
     
     P, L = U.shape
-    m_Y = lambda w: y_cond_mean(w, x)
-    Cov_Y = lambda w: y_cond_cov(w, x)
         
     # Sample from observation model
-    ys = emission_dist(m_Y(m), Cov_Y(m)).sample(seed=key, sample_shape=(n_sample,))
+    ys = emission_dist(y_cond_mean(m, x), y_cond_cov(m, x)).sample(seed=key, sample_shape=(n_sample,))
     # Compute gradients and average
     grad_fn = lambda y: grad(log_likelihood, argnums=0)(m, x, y)
     pseudo_gll = jnp.mean(vmap(grad_fn)(ys), axis=0).reshape(-1, 1)
@@ -978,8 +1214,9 @@ def _lofi_diagonal_gradient_resample_condition_on(
     W_extra = Lambda_extra * U_extra
     Ups_cond = Ups + jnp.einsum('ij,ij->i', W_extra, W_extra)[:, jnp.newaxis]
     
-    G = jnp.linalg.pinv(jnp.eye(W_tilde.shape[1]) + W_tilde.T @ (W_tilde/Ups))
-    K = gll/Ups - (W_tilde/Ups @ G) @ ((W_tilde/Ups).T @ gll)
+    W_scaled = W_tilde/Ups
+    G = jnp.linalg.pinv(jnp.eye(W_tilde.shape[1]) + W_tilde.T @ W_scaled)
+    K = gll/Ups - (W_scaled @ G) @ (W_scaled.T @ gll)
     m_cond = m + K.ravel()
     
     return m_cond, U_cond, Lambda_cond, Ups_cond
@@ -1094,8 +1331,9 @@ def _lofi_diagonal_gradient_momentum_condition_on(
     W_extra = Lambda_extra * U_extra
     Ups_cond = Ups + jnp.einsum('ij,ij->i', W_extra, W_extra)[:, jnp.newaxis]
     
-    G = jnp.linalg.pinv(jnp.eye(W_tilde.shape[1]) + W_tilde.T @ (W_tilde/Ups))
-    K = gll/Ups - (W_tilde/Ups @ G) @ ((W_tilde/Ups).T @ gll)
+    W_scaled = W_tilde/Ups
+    G = jnp.linalg.pinv(jnp.eye(W_tilde.shape[1]) + W_tilde.T @ W_scaled)
+    K = gll/Ups - (W_scaled @ G) @ (W_scaled.T @ gll)
     m_cond = m + K.ravel()
     
     # Update momentum
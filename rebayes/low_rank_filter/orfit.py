@@ -2,7 +2,7 @@ from functools import partial
 from typing import Any, Callable, Union
 
 import chex
-from jax import jacrev, jit, vmap
+from jax import jacrev, jit
 import jax.numpy as jnp
 from jaxtyping import Float, Array
 import tensorflow_probability.substrates.jax as tfp
@@ -24,10 +24,11 @@ tfd = tfp.distributions
 MVN = tfd.MultivariateNormalTriL
 
 # Helper functions
-_stable_division = lambda a, b: jnp.where(b.any(), a / b, jnp.zeros(shape=a.shape))
-_project = lambda a, x: _stable_division(a * (a.T @ x), (a.T @ a))
-_project_to_columns = lambda A, x: \
-    jnp.where(A.any(), vmap(_project, (1, None))(A, x).sum(axis=0), jnp.zeros(shape=x.shape))
+# Double-where keeps a/0 (and its gradient) out of the result without a reduction
+_stable_division = lambda a, b: jnp.where(b != 0, a / jnp.where(b != 0, b, 1.0), 0.0)
+# Columns of the ORFit basis are orthonormal (or zero), so the projection
+# onto their span is a single GEMM pair rather than a sum of outer products.
+_project_to_columns = lambda A, x: A @ (A.T @ x)
 
 
 @chex.dataclass
@@ -2,8 +2,10 @@ from functools import partial
 from typing import Any, Callable, NamedTuple, Tuple, Union
 
 import chex
-from jax import jit, lax, vmap, tree_util
+from jax import disable_jit, jit, lax, vmap, tree_util
 import jax.numpy as jnp
+import numpy as np
+from jax.scipy.linalg import cho_solve
 from jax_tqdm import scan_tqdm
 from jaxtyping import Array, Float
 import tensorflow_probability.substrates.jax as tfp
@@ -13,9 +15,12 @@ from rebayes.base import (
     EmissionDistFn,
     FnStateAndInputToEmission,
     Rebayes,
+    _split_step_keys,
 )
 from rebayes.low_rank_filter.lofi_core import (
     _jacrev_2d,
+    _linearize_emission,
+    _matmul,
     _lofi_spherical_cov_inflate,
     _lofi_spherical_cov_predict,
     _lofi_spherical_cov_svd_free_predict,
@@ -27,6 +32,7 @@ from rebayes.low_rank_filter.lofi_core import (
     _lofi_diagonal_cov_predict,
     _replay_lofi_diagonal_cov_condition_on,
     _replay_lofi_diagonal_cov_svd_free_condition_on,
+    _replay_lofi_diagonal_cov_batch_condition_on,
 )
 from rebayes.utils.sampling import sample_dlr
 
@@ -47,21 +53,25 @@ INFLATION_METHODS = [
 FnStateStateInputToEmission = Callable[ [Float[Array, "state_dim"], Float[Array, "state_dim"], Float[Array, "input_dim"] ], Float[Array, "emission_dim"]]
 
 
+def _default_emission_dist(mean, cov):
+    return MVN(loc=mean, scale_tril=jnp.linalg.cholesky(cov))
+
+
 def _initialize_buffer(item, buffer_size):
-    ndim = 0
-    if isinstance(item, jnp.ndarray):
-        ndim = item.ndim
-    pad_arg = [[0, 0]] * ndim
-    buffer = jnp.pad(
-        jnp.expand_dims(item, 0), 
-        [[buffer_size-1, 0], *pad_arg], 
-        'constant', 
-        constant_values=0
-    )
+    item = jnp.asarray(item)
+    buffer = jnp.zeros((buffer_size, *item.shape), dtype=item.dtype).at[-1].set(item)
 
     return buffer
 
 
+# Belief fields with a replay buffer named buffer_<field>. Every buffer is
+# stored slot-major, (buffer_size, *field_shape), so that a slot is one
+# contiguous block for both the circular write and the replay read.
+PARAM_BUFFER_FIELDS = (
+    'pp_mean', 'mean', 'basis', 'svs', 'eta', 'Ups', 'obs_noise_var',
+)
+
+
 @chex.dataclass
 class ReplayLoFiBel:
     buffer_X: chex.Array
@@ -86,42 +96,52 @@ class ReplayLoFiBel:
     Ups: CovMat = None
     nobs: int = 0
     obs_noise_var: float = 1.0
+    head: int = 0 # Circular-buffer slot of the oldest entry, written next
     
     def _update_buffer(self, buffer, item):
-        buffer_new = jnp.concatenate([buffer[1:], jnp.expand_dims(item, 0)], axis=0)
+        buffer_new = buffer.at[self.head].set(item)
 
         return buffer_new
+    
+    def buffer_slot(self, t):
+        """Return the slot of the t-th oldest IO entry, once the current
+        observation has been written to the IO buffers."""
+        buffer_size = self.buffer_X.shape[0]
+        
+        return (self.head + 1 + t) % buffer_size
+
+    def _update_buffers(self, items):
+        buffers = {name: getattr(self, name) for name in items}
+        buffers = tree_util.tree_map(self._update_buffer, buffers, items)
+
+        return buffers
 
     def apply_io_buffers(self, X, y):
-        buffer_X = self._update_buffer(self.buffer_X, X)
-        buffer_y = self._update_buffer(self.buffer_y, y)
+        buffers = self._update_buffers({
+            'buffer_X': X,
+            'buffer_y': y,
+        })
 
-        return self.replace(
-            buffer_X=buffer_X,
-            buffer_y=buffer_y,
-        )
+        return self.replace(**buffers)
     
     def apply_param_buffers(self):
-        m0, m , U, Lambda, eta, Ups, obs_noise_var = \
-            self.pp_mean, self.mean, self.basis, self.svs, self.eta, self.Ups, self.obs_noise_var
-        buffer_pp_mean = self._update_buffer(self.buffer_pp_mean, m0)
-        buffer_mean = self._update_buffer(self.buffer_mean, m)
-        buffer_basis = self._update_buffer(self.buffer_basis, U)
-        buffer_svs = self._update_buffer(self.buffer_svs, Lambda)
-        buffer_eta = self._update_buffer(self.buffer_eta, eta)
-        buffer_Ups = self._update_buffer(self.buffer_Ups, Ups)
-        buffer_obs_noise_var = self._update_buffer(self.buffer_obs_noise_var, obs_noise_var)
+        buffers = self._update_buffers({
+            f'buffer_{name}': getattr(self, name) for name in PARAM_BUFFER_FIELDS
+        })
 
         return self.replace(
-            buffer_pp_mean=buffer_pp_mean,
-            buffer_mean=buffer_mean,
-            buffer_basis=buffer_basis,
-            buffer_svs=buffer_svs,
-            buffer_eta=buffer_eta,
-            buffer_Ups=buffer_Ups,
-            buffer_obs_noise_var=buffer_obs_noise_var,
+            **buffers,
+            head=(self.head + 1) % self.buffer_X.shape[0],
         )
     
+    def load_param_buffers(self, slot):
+        params = tree_util.tree_map(
+            lambda buffer: buffer[slot],
+            {name: getattr(self, f'buffer_{name}') for name in PARAM_BUFFER_FIELDS}
+        )
+
+        return self.replace(**params)
+    
 
 class ReplayLoFiParams(NamedTuple):
     buffer_size: int
@@ -133,8 +153,7 @@ class ReplayLoFiParams(NamedTuple):
     dynamics_covariance: CovMat
     emission_mean_function: FnStateAndInputToEmission
     emission_cov_function: FnStateStateInputToEmission
-    emission_dist: EmissionDistFn = \
-        lambda mean, cov: MVN(loc=mean, scale_tril=jnp.linalg.cholesky(cov))
+    emission_dist: EmissionDistFn = _default_emission_dist
     adaptive_emission_cov: bool=False
     dynamics_covariance_inflation_factor: float=0.0
     memory_size: int = 10
@@ -142,6 +161,11 @@ class ReplayLoFiParams(NamedTuple):
     inflation: str = 'bayesian'
     use_svd: bool = True
     n_inner: int = 1
+    linearize_once: bool = False # Linearize the whole replay buffer up front (always if n_inner > 1)
+    parallel_replay: bool = False # Absorb the replay buffer in one batched update
+    compute_dtype: Any = None # e.g. jnp.bfloat16 for the (state_dim, memory_size) GEMMs
+    max_ntime: int = None # Pad scan inputs to this length to avoid retracing
+    compile_cache: bool = False # Keep AOT-compiled scans keyed on input shapes
 
 
 class RebayesReplayLoFi(Rebayes):
@@ -149,7 +173,14 @@ class RebayesReplayLoFi(Rebayes):
         self,
         params: ReplayLoFiParams,
     ):
-        super().__init__(params)
+        super().__init__(
+            params.dynamics_covariance, params.emission_mean_function,
+            params.emission_cov_function, params.emission_dist,
+            params.adaptive_emission_cov,
+        )
+        self.params = params
+        self._compiled_scans = {}
+        self._jitted_scans = {}
         
         # Check inflation type
         if params.inflation not in INFLATION_METHODS:
@@ -227,34 +258,79 @@ class RebayesReplayLoFi(Rebayes):
 
         return y_pred
     
-    @partial(jit, static_argnums=(0,))
     def predict_state(
+        self,
         bel: ReplayLoFiBel,
     ) -> ReplayLoFiBel:
         
         raise NotImplementedError
     
-    @partial(jit, static_argnums=(0,))
+    def sample_state(
+        self,
+        bel: ReplayLoFiBel,
+        key: Array,
+        n_samples: int = 100,
+        temperature: float = 1.0,
+    ) -> Float[Array, "n_samples state_dim"]:
+        
+        raise NotImplementedError
+    
     def _update_state(
+        self,
         bel: ReplayLoFiBel,
         x: Float[Array, "input_dim"],
         y: Float[Array, "output_dim"],
+        lin: Tuple = None,
     ) -> ReplayLoFiBel:
         
         raise NotImplementedError
     
-    @partial(jit, static_argnums=(0,))
+    def _update_state_batch(
+        self,
+        bel: ReplayLoFiBel,
+        X: Float[Array, "buffer_size input_dim"],
+        Y: Float[Array, "buffer_size output_dim"],
+        lin_buffer: Tuple = None,
+    ) -> ReplayLoFiBel:
+        
+        raise NotImplementedError
+    
+    def linearize_buffer(
+        self,
+        bel: ReplayLoFiBel,
+    ) -> Tuple[Float[Array, "buffer_size output_dim"], 
+               Float[Array, "buffer_size output_dim state_dim"]]:
+        """Linearize the emission at bel.mean_lin for every buffered input."""
+        lin_fn = lambda x: _linearize_emission(
+            self.params.emission_mean_function, bel.mean_lin, x
+        )
+        
+        return vmap(lin_fn)(bel.buffer_X)
+    
     def replay_update_step(
         self,
         bel: ReplayLoFiBel,
+        lin_buffer: Tuple = None,
     ) -> ReplayLoFiBel:
         X, y = bel.buffer_X, bel.buffer_y
         init_nobs = bel.nobs
         num_timesteps = X.shape[0]
+        if self.params.parallel_replay:
+            # Dynamics are applied once for the whole buffer.
+            bel_pred = self.predict_state(bel)
+            bel = self._update_state_batch(bel_pred, X, y, lin_buffer)
+            bel = bel.replace(nobs=init_nobs)
+            
+            return bel
+        
         def _step(t, bel):
             bel_pred = self.predict_state(bel)
             # bel_pred = bel_pred.replace(mean_lin = bel_pred.mean)
-            bel = self._update_state(bel_pred, X[t], y[t])
+            slot = bel.buffer_slot(t)
+            lin = None
+            if lin_buffer is not None:
+                lin = tree_util.tree_map(lambda buffer: buffer[slot], lin_buffer)
+            bel = self._update_state(bel_pred, X[slot], y[slot], lin)
             
             return bel
         bel = lax.fori_loop(0, num_timesteps, _step, bel)
@@ -262,7 +338,6 @@ class RebayesReplayLoFi(Rebayes):
         
         return bel
     
-    @partial(jit, static_argnums=(0,))
     def update_state_without_replay(
         self,
         bel: ReplayLoFiBel,
@@ -276,7 +351,6 @@ class RebayesReplayLoFi(Rebayes):
         
         return bel
     
-    @partial(jit, static_argnums=(0,))
     def update_state_with_replay(
         self,
         bel: ReplayLoFiBel,
@@ -284,19 +358,16 @@ class RebayesReplayLoFi(Rebayes):
         y: Float[Array, "output_dim"],
     ) -> ReplayLoFiBel:
         bel = bel.apply_io_buffers(x, y)
-        bel = bel.replace(
-            pp_mean = bel.buffer_pp_mean[0],
-            mean = bel.buffer_mean[0],
-            mean_lin = bel.mean,
-            basis = bel.buffer_basis[0],
-            svs = bel.buffer_svs[0],
-            eta = bel.buffer_eta[0],
-            Ups = bel.buffer_Ups[0],
-            obs_noise_var = bel.buffer_obs_noise_var[0],
-        )
+        bel = bel.replace(mean_lin = bel.mean)
+        bel = bel.load_param_buffers(bel.head)
         
+        # mean_lin is fixed for all inner passes, so with several passes the
+        # buffer Jacobians are computed once and shared between them.
+        linearize_once = self.params.linearize_once or self.params.parallel_replay \
+            or self.params.n_inner > 1
+        lin_buffer = self.linearize_buffer(bel) if linearize_once else None
         def partial_step(_, bel):
-            bel = self.replay_update_step(bel)
+            bel = self.replay_update_step(bel, lin_buffer)
             
             return bel
         bel = lax.fori_loop(0, self.params.n_inner, partial_step, bel)
@@ -305,6 +376,23 @@ class RebayesReplayLoFi(Rebayes):
         
         return bel
     
+    def update_state(
+        self,
+        bel: ReplayLoFiBel,
+        x: Float[Array, "input_dim"],
+        y: Float[Array, "output_dim"],
+    ) -> ReplayLoFiBel:
+        """Absorb (x, y). As in `scan`, the buffer is only replayed once it
+        holds buffer_size - 1 earlier observations."""
+        bel = lax.cond(
+            bel.nobs < self.params.buffer_size - 1,
+            self.update_state_without_replay,
+            self.update_state_with_replay,
+            bel, x, y
+        )
+        
+        return bel
+    
     def scan(
         self,
         X: Float[Array, "ntime input_dim"],
@@ -319,47 +407,94 @@ class RebayesReplayLoFi(Rebayes):
     ) -> Tuple[ReplayLoFiBel, Any]:
         """Apply filtering to entire sequence of data. Return final belief state and outputs from callback."""
         num_timesteps = X.shape[0]
-        def step(bel, t, update_fn):
-            bel_pred = self.predict_state(bel)
-            pred_obs = self.predict_obs(bel, X[t])
-            bel = update_fn(bel_pred, X[t], Y[t])
-            out = None
-            if callback is not None:
-                out = callback(bel, pred_obs, t, X[t], Y[t], bel_pred, **kwargs)
+        warmup_steps = self.params.buffer_size-1
+        scan_length = num_timesteps
+        if self.params.max_ntime is not None:
+            # Pad to a fixed length so that repeated calls reuse one compilation.
+            if num_timesteps > self.params.max_ntime:
+                raise ValueError(f"Sequence length {num_timesteps} exceeds max_ntime.")
+            scan_length = self.params.max_ntime
+            pad = lambda A: jnp.pad(A, [(0, scan_length-num_timesteps)] + [(0, 0)]*(A.ndim-1))
+            X, Y = pad(X), pad(Y)
+        valid = jnp.arange(scan_length) < num_timesteps
+        # Array kwargs are traced; the others (agent, apply_fn, ...) are
+        # constants of the scan and part of the compilation cache key.
+        is_array = lambda v: isinstance(v, (Array, np.ndarray))
+        array_kwargs = {k: v for k, v in kwargs.items() if is_array(v)}
+        static_kwargs = tuple(sorted(
+            (k, v) for k, v in kwargs.items() if not is_array(v)
+        ))
+        def _scan(carry, X, Y, valid, array_kwargs):
+            kwargs = {**array_kwargs, **dict(static_kwargs)}
+            step_keys = _split_step_keys(callback, kwargs, scan_length)
+            def step(bel, inputs):
+                t, is_valid = inputs
+                bel_pred = self.predict_state(bel)
+                # Only the callback consumes pred_obs; skip the forward pass otherwise.
+                pred_obs = self.predict_obs(bel, X[t]) if callback is not None else None
+                def _update(bel_pred, x, y):
+                    return lax.cond(
+                        t < warmup_steps,
+                        self.update_state_without_replay,
+                        self.update_state_with_replay,
+                        bel_pred, x, y
+                    )
+                if self.params.max_ntime is not None:
+                    # Padded steps skip the update and keep the incoming belief.
+                    bel_cond = lax.cond(
+                        is_valid, _update, lambda *_: bel, bel_pred, X[t], Y[t]
+                    )
+                else:
+                    bel_cond = _update(bel_pred, X[t], Y[t])
+                out = None
+                if callback is not None:
+                    cb_kwargs = kwargs if step_keys is None else {**kwargs, "key_t": step_keys[t]}
+                    out = callback(bel_cond, pred_obs, t, X[t], Y[t], bel_pred, **cb_kwargs)
+                
+                return bel_cond, out
+            if progress_bar:
+                step = scan_tqdm(scan_length)(step)
             
-            return bel, out
-        warmup_steps = min(self.params.buffer_size-1, num_timesteps)
-        step_without_replay = partial(step, update_fn=self.update_state_without_replay)
-        step_with_replay = partial(step, update_fn=self.update_state_with_replay)
+            return lax.scan(step, carry, (jnp.arange(scan_length), valid))
         carry = bel
         if bel is None:
             if Xinit is not None:
                 carry = self.init_bel(Xinit, Yinit)
             else:
                 carry = self.init_bel()
-        if progress_bar:
-            step_with_replay = scan_tqdm(num_timesteps)(step_with_replay)
+        args = (carry, X, Y, valid, array_kwargs)
         if debug:
-            outputs = []
-            for t in range(warmup_steps):
-                carry, out = step_without_replay(carry, t)
-                outputs.append(out)
-            for t in range(warmup_steps, num_timesteps):
-                carry, out = step_with_replay(carry, t)
-                outputs.append(out)
-            bel = carry
-            outputs = jnp.stack(outputs)
+            # Step through the same scan eagerly, one timestep at a time.
+            with disable_jit():
+                bel, outputs = _scan(*args)
+        elif self.params.compile_cache:
+            # Reuse the ahead-of-time compiled scan for matching input shapes.
+            args = tree_util.tree_map(jnp.asarray, args)
+            leaves, treedef = tree_util.tree_flatten(args)
+            key = (callback, progress_bar, static_kwargs, treedef,
+                   tuple((l.shape, l.dtype, l.weak_type) for l in leaves))
+            try:
+                if key not in self._compiled_scans:
+                    self._compiled_scans[key] = jit(_scan).lower(*args).compile()
+                compiled = self._compiled_scans[key]
+            except TypeError: # unhashable static kwarg
+                compiled = _scan
+            bel, outputs = compiled(*args)
+        elif self.params.max_ntime is not None:
+            # The padded scan does not depend on the sequence length, so one
+            # jitted scan per configuration serves every call.
+            key = (callback, progress_bar, static_kwargs, scan_length)
+            try:
+                if key not in self._jitted_scans:
+                    self._jitted_scans[key] = jit(_scan)
+                jitted = self._jitted_scans[key]
+            except TypeError: # unhashable static kwarg
+                jitted = _scan
+            bel, outputs = jitted(*args)
         else:
-            bel, outputs1 = lax.scan(step_without_replay, carry, jnp.arange(warmup_steps))
-            bel, outputs2 = lax.scan(step_with_replay, bel, jnp.arange(warmup_steps, num_timesteps))
-            if outputs1 is None:
-                outputs = outputs2
-            elif outputs2 is None:
-                outputs = outputs1
-            else:
-                outputs = tree_util.tree_map(
-                    lambda l1, l2: jnp.concatenate([l1, l2]), outputs1, outputs2
-                )
+            bel, outputs = _scan(*args)
+        if scan_length > num_timesteps:
+            outputs = tree_util.tree_map(lambda out: out[:num_timesteps], outputs)
         return bel, outputs
     
 
@@ -370,7 +505,6 @@ class RebayesReplayLoFiDiagonal(RebayesReplayLoFi):
     ):
         super().__init__(params)
 
-    @partial(jit, static_argnums=(0,))
     def predict_state(
         self,
         bel: ReplayLoFiBel,
@@ -405,8 +539,8 @@ class RebayesReplayLoFiDiagonal(RebayesReplayLoFi):
         bel: ReplayLoFiBel,
         x: Float[Array, "input_dim"]
     ) -> Union[Float[Array, "output_dim output_dim"], Any]:
-        m, U, Lambda, obs_noise_var, Ups = \
-            bel.mean, bel.basis, bel.svs, bel.eta, bel.obs_noise_var
+        m, U, Lambda, Ups, obs_noise_var = \
+            bel.mean, bel.basis, bel.svs, bel.Ups, bel.obs_noise_var
         m_Y = lambda z: self.params.emission_mean_function(z, x)
         Cov_Y = lambda z: self.params.emission_cov_function(z, z, x)
 
@@ -419,19 +553,22 @@ class RebayesReplayLoFiDiagonal(RebayesReplayLoFi):
 
         P, L = U.shape
         W = U * Lambda
-        G = jnp.linalg.pinv(jnp.eye(L) +  W.T @ (W/Ups))
-        HW = H/Ups @ W
-        V_epi = H @ H.T/Ups - (HW @ G) @ (HW).T
+        H_scaled = H/Ups.T
+        HW = _matmul(H_scaled, W, self.params.compute_dtype)
+        G_chol = jnp.linalg.cholesky(
+            jnp.eye(L) + _matmul(W.T, W/Ups, self.params.compute_dtype)
+        )
+        V_epi = H_scaled @ H.T - HW @ cho_solve((G_chol, True), HW.T)
         Sigma_obs = V_epi + R
 
         return Sigma_obs
 
-    @partial(jit, static_argnums=(0,))
     def _update_state(
         self,
         bel: ReplayLoFiBel,
         x: Float[Array, "input_dim"],
         y: Float[Array, "output_dim"],
+        lin: Tuple = None,
     ) -> ReplayLoFiBel:
         m, m_lin, U, Lambda, Ups, nobs, obs_noise_var = \
             bel.mean, bel.mean_lin, bel.basis, bel.svs, bel.Ups, bel.nobs, bel.obs_noise_var
@@ -443,7 +580,8 @@ class RebayesReplayLoFiDiagonal(RebayesReplayLoFi):
         m_cond, U_cond, Lambda_cond, Ups_cond = \
             update_fn(m, m_lin, U, Lambda, Ups, self.params.emission_mean_function,
                       self.params.emission_cov_function, x, y,
-                      self.params.adaptive_emission_cov, obs_noise_var)
+                      self.params.adaptive_emission_cov, obs_noise_var, lin,
+                      self.params.compute_dtype)
 
         # Estimate emission covariance.
         nobs_est, obs_noise_var_est = \
@@ -461,41 +599,105 @@ class RebayesReplayLoFiDiagonal(RebayesReplayLoFi):
 
         return bel_cond
 
-    @partial(jit, static_argnums=(0,4))
-    def pred_obs_mc(self, key, bel, x, shape=None):
+    def _update_state_batch(
+        self,
+        bel: ReplayLoFiBel,
+        X: Float[Array, "buffer_size input_dim"],
+        Y: Float[Array, "buffer_size output_dim"],
+        lin_buffer: Tuple = None,
+    ) -> ReplayLoFiBel:
+        m, m_lin, U, Lambda, Ups, nobs, obs_noise_var = \
+            bel.mean, bel.mean_lin, bel.basis, bel.svs, bel.Ups, bel.nobs, bel.obs_noise_var
+
+        # Condition on all buffered observations.
+        m_cond, U_cond, Lambda_cond, Ups_cond = \
+            _replay_lofi_diagonal_cov_batch_condition_on(
+                m, m_lin, U, Lambda, Ups, self.params.emission_mean_function,
+                self.params.emission_cov_function, X, Y,
+                self.params.adaptive_emission_cov, obs_noise_var, lin_buffer,
+                self.params.compute_dtype
+            )
+
+        # Estimate emission covariance.
+        if self.params.adaptive_emission_cov:
+            def _estimate_noise(t, carry):
+                return _lofi_estimate_noise(m_cond, self.params.emission_mean_function,
+                                            X[t], Y[t], *carry, True)
+            nobs_est, obs_noise_var_est = lax.fori_loop(
+                0, X.shape[0], _estimate_noise, 
+                (nobs, jnp.asarray(obs_noise_var, dtype=m_cond.dtype))
+            )
+        else:
+            nobs_est, obs_noise_var_est = nobs + X.shape[0], 0.0
+        bel_cond = bel.replace(
+            mean = m_cond,
+            basis = U_cond,
+            svs = Lambda_cond,
+            Ups = Ups_cond,
+            nobs = nobs_est,
+            obs_noise_var = obs_noise_var_est,
+        )
+
+        return bel_cond
+
+    @partial(jit, static_argnums=(0, 3))
+    def sample_state(
+        self,
+        bel: ReplayLoFiBel,
+        key: Array,
+        n_samples: int = 100,
+        temperature: float = 1.0,
+    ) -> Float[Array, "n_samples state_dim"]:
+        bel = self.predict_state(bel)
+        shape = (n_samples,)
+        params_sample = \
+            sample_dlr(key, bel.basis, bel.Ups.ravel(), temperature, shape) + bel.mean
+        
+        return params_sample
+
+    @partial(jit, static_argnames=("self", "shape"))
+    def pred_obs_mc(self, key, bel, x, shape=(1,)):
         """
         Sample observations from the posterior predictive distribution.
         """
-        shape = shape or (1,)
+        shape = tuple(shape) if shape else (1,)
         # Belief posterior predictive.
         bel = self.predict_state(bel)
-        params_sample = sample_dlr(key, bel.basis, bel.Ups.ravel(), shape) + bel.mean
+        params_sample = sample_dlr(key, bel.basis, bel.Ups.ravel(), 1.0, shape) + bel.mean
         yhat_samples = vmap(self.params.emission_mean_function, (0, None))(params_sample, x)
         return yhat_samples
 
     @partial(jit, static_argnames=("self", "n_samples"))
-    def nlpd_mc(self, key, bel, x, y, n_samples=30):
+    def nlpd_mc(self, bel, key, x, y, n_samples=30, temperature=1.0):
         """
         Compute the negative log predictive density (nlpd) as
-        a Monte Carlo estimate.
-        llfn: log likelihood function
-            Takes mean, x, y
+        a Monte Carlo estimate. As in `Rebayes.nlpd_mc`, the samples are
+        shared by all points in `x` and the result has shape (n_samples, ntime).
         """
         x = jnp.atleast_2d(x)
         y = jnp.atleast_2d(y)
         shape = (n_samples,)
         bel = self.predict_state(bel)
-        params_sample = sample_dlr(key, bel.basis, bel.Ups.ravel(), shape) + bel.mean
-        scale = jnp.sqrt(self.params.emission_cov_function(0.0, 0.0, 0.0))
-        def llfn(params, x, y):
-            y = y.ravel()
-            mean = self.params.emission_mean_function(params, x).ravel()
-            log_likelihood = self.params.emission_dist(mean, scale).log_prob(y)
-            return log_likelihood.sum()
-
-        # Compute vectorised nlpd
-        vnlpd = vmap(llfn, (0, None, None))
-        vnlpd = vmap(vnlpd, (None, 0, 0))
-        nlpd_vals = -vnlpd(params_sample, x, y).squeeze()
-
-        return nlpd_vals.mean(axis=-1)
\ No newline at end of file
+        params_sample = \
+            sample_dlr(key, bel.basis, bel.Ups.ravel(), temperature, shape) + bel.mean
+        
+        # Predicted means for every (x, sample) pair: (n_x, n_samples, C)
+        m_Y = lambda params, x: self.params.emission_mean_function(params, x).ravel()
+        means = vmap(vmap(m_Y, (0, None)), (None, 0))(params_sample, x)
+        y = y.reshape(y.shape[0], 1, -1)
+        
+        cov = jnp.asarray(self.params.emission_cov_function(0.0, 0.0, 0.0))
+        if self.params.emission_dist is not _default_emission_dist:
+            llfn = lambda mean, y: self.params.emission_dist(mean, cov).log_prob(y).sum()
+            log_likelihood = vmap(vmap(llfn, (0, None)))(means, y[:, 0])
+        elif cov.ndim < 2:
+            # Diagonal noise: skip the Cholesky altogether.
+            scale_diag = jnp.broadcast_to(jnp.sqrt(cov), means.shape)
+            log_likelihood = \
+                tfd.MultivariateNormalDiag(loc=means, scale_diag=scale_diag).log_prob(y)
+        else:
+            scale_tril = jnp.linalg.cholesky(cov)
+            log_likelihood = MVN(loc=means, scale_tril=scale_tril).log_prob(y)
+        nlpd_vals = -log_likelihood.reshape(x.shape[0], n_samples).T
+
+        return nlpd_vals
\ No newline at end of file
@@ -2,46 +2,147 @@
 Custom callbacks
 """
 
-from functools import partial
+from collections.abc import Mapping
+from functools import lru_cache, partial, wraps
+import math
 
 import jax
 from jax import vmap
 import jax.numpy as jnp
-import distrax
+import numpy as np
 import optax
 
 
 # ------------------------------------------------------------------------------
 # Common Callbacks
 
-@partial(jax.jit, static_argnums=(1,4,5))
+def _nan_guard(value, nan_val=None):
+    """Replace NaNs in `value` by `nan_val` (no-op if `nan_val` is None)."""
+    if nan_val is None:
+        return value
+    return jnp.where(jnp.isnan(value), nan_val, value)
+
+
+@lru_cache(maxsize=None)
+def _compile_callback(callback, static_kwargs):
+    return jax.jit(partial(callback, **dict(static_kwargs)))
+
+
+def _jit_callback(callback):
+    """
+    Compile `callback` end to end (slicing, forward pass, losses and result
+    dict) into a single XLA computation per configuration.
+    Array keyword arguments (test sets, keys, ...) are traced; all other keyword
+    arguments (apply_fn, agent, task index, ...) are static and key the cache.
+    """
+    @wraps(callback)
+    def wrapped(*args, **kwargs):
+        is_array = lambda v: isinstance(v, (jax.Array, np.ndarray))
+        static_kwargs = tuple(sorted(
+            (k, v) for k, v in kwargs.items() if not is_array(v)
+        ))
+        dynamic_kwargs = {k: v for k, v in kwargs.items() if is_array(v)}
+        try:
+            compiled = _compile_callback(callback, static_kwargs)
+        except TypeError: # unhashable static argument
+            return callback(*args, **kwargs)
+        return compiled(*args, **dynamic_kwargs)
+    
+    return wrapped
+
+
+def _step_key(t, kwargs):
+    """
+    Random key for step `t`: the scan's precomputed `key_t` if given,
+    otherwise folded in from `key`.
+    """
+    if "key_t" in kwargs:
+        return kwargs["key_t"]
+    return jax.random.fold_in(kwargs["key"], t)
+
+
+def _window(A, t, steps, axis=0):
+    """Contiguous window of `steps` entries centred at `t`.
+
+    The start is clipped to [0, len(A) - steps] so that windows near either
+    end stay inside `A`; being a dynamic slice (not a gather), a traced `t`
+    neither recompiles nor copies indices. If `A` has fewer than `steps`
+    entries, the indices are clipped one by one, repeating the edge entries.
+    """
+    size = A.shape[axis]
+    if size < steps:
+        slice_ix = jnp.arange(0, steps) + t - steps // 2
+        return jnp.take(A, slice_ix, axis=axis, mode="clip")
+    start = jnp.clip(t - steps // 2, 0, size - steps)
+    return jax.lax.dynamic_slice_in_dim(A, start, steps, axis=axis)
+
+
+def _batched_apply(flat_params, apply_fn, X):
+    """
+    Map `apply_fn` over the leading axis of `X`, each example given as a
+    single-element batch. Models that ravel their input (e.g. `MLP`) only
+    see one example at a time; under vmap XLA still lowers the dense layers
+    to one matmul over the whole batch.
+    """
+    def apply_one(x):
+        return apply_fn(flat_params, jnp.array(x, ndmin=4)).ravel()
+    
+    return vmap(apply_one)(X)
+
+
+def _forward(flat_params, apply_fn, X_test, dtype=None):
+    """
+    Forward pass over the test set returning (n_test, -1) logits. If `dtype`
+    is given (e.g. jnp.bfloat16), parameters and inputs are cast to it for the
+    forward and the logits are cast back to float32 for the loss.
+    """
+    if dtype is not None:
+        flat_params = jax.tree_map(lambda A: A.astype(dtype), flat_params)
+        X_test = X_test.astype(dtype)
+    logits = _batched_apply(flat_params, apply_fn, X_test).reshape(X_test.shape[0], -1)
+    if dtype is not None:
+        logits = logits.astype(jnp.float32)
+    
+    return logits
+
+
+def _match_targets(logits, y):
+    """Drop the trailing unit output axis of (n, 1) logits for (n,) targets."""
+    if y.ndim == 1 and logits.shape[-1] == 1:
+        logits = logits[:, 0]
+    return logits
+
+
+@partial(jax.jit, static_argnames=("apply_fn", "loss_fn", "label", "nan_val", "dtype"))
 def evaluate_function(flat_params, apply_fn, X_test, y_test, loss_fn, 
-                      label="loss", **kwargs):
-    def evaluate(label, image):
-        image = jnp.array(image, ndmin=4)
-        logits = apply_fn(flat_params, image).ravel()
-        loss = loss_fn(logits, label, **kwargs)
-        
-        return loss
-    evals = jax.vmap(evaluate, (0, 0))(y_test, X_test)
+                      label="loss", nan_val=None, dtype=None, **kwargs):
+    # One forward pass over the test set; `loss_fn` is applied to the whole
+    # batch of logits.
+    logits = _forward(flat_params, apply_fn, X_test, dtype)
+    loss_fn = partial(loss_fn, **kwargs)
+    evals = _nan_guard(loss_fn(_match_targets(logits, y_test), y_test).mean(), nan_val)
     result = {
-        label: evals.mean()
+        label: evals
     }
     
     return result
     
 
+@_jit_callback
 def cb_eval(bel, *args, evaluate_fn, nan_val=-1e8, **kwargs):
+    """
+    Evaluate the posterior mean on the test set, replacing NaN results by
+    `nan_val`. The callback is compiled as a whole, so the replacement is
+    fused with `evaluate_fn`.
+    """
     X, y, apply_fn = kwargs["X_test"], kwargs["y_test"], kwargs["apply_fn"]
     eval = evaluate_fn(bel.mean, apply_fn, X, y)
-    if isinstance(eval, dict):
-        eval = {k: jnp.where(jnp.isnan(v), nan_val, v) for k, v in eval.items()}
-    else:
-        eval = jnp.where(jnp.isnan(eval), nan_val, eval)
+    eval = jax.tree_map(partial(_nan_guard, nan_val=nan_val), eval)
     
     return eval
 
 
+@_jit_callback
 def cb_osa(bel, y_pred, t, X, y, bel_pred, evaluate_fn, nan_val=-1e8, 
            label="loss", **kwargs):
     eval = evaluate_fn(y_pred, y)
@@ -53,60 +154,166 @@ def cb_osa(bel, y_pred, t, X, y, bel_pred, evaluate_fn, nan_val=-1e8,
     return result
 
 
+@_jit_callback
 def cb_mc_osa(bel, y_pred, t, X, y, bel_pred, nan_val=-1e8,
               temperature=1.0, linearize=False, aleatoric_factor=1.0, 
               label="loss", classification=False, **kwargs):
+    """
+    One-step-ahead log predictive density of (X, y) under `bel_pred`, either
+    from the linearised predictive or as a Monte Carlo estimate.
+    """
     apply_fn, agent = kwargs["apply_fn"], kwargs["agent"]
-    key = jax.random.fold_in(kwargs["key"], t)
     X = jnp.atleast_2d(X)[None, None, :]
     y = jnp.atleast_1d(y)
     if linearize:
         if classification:
-            llfn = partial(clf_linearized_llfn, bel=bel_pred, agent=agent,
-                           apply_fn=apply_fn, cooling_factor=aleatoric_factor,
-                           int_labels=False)
-            lpd = vmap(llfn)(X, jnp.atleast_2d(y)).mean()
+            # A single observation: no need to map over the unit batch axis
+            lpd = clf_linearized_llfn(
+                X[0], y, bel=bel_pred, agent=agent, apply_fn=apply_fn,
+                cooling_factor=aleatoric_factor, int_labels=False
+            )
         else:
             lpd = agent.evaluate_log_prob(bel_pred, X, y, aleatoric_factor)
     else:
+        key = _step_key(t, kwargs)
         nlpd = agent.nlpd_mc(bel_pred, key, X, y, temperature=temperature)
         lpd = -nlpd
     lpd = {
-        "lpd": jnp.where(jnp.isnan(lpd), nan_val, lpd.mean())
+        "lpd": _nan_guard(lpd.mean(), nan_val)
     }
     
     return lpd
 
 
+@partial(jax.jit, static_argnames=("apply_fn", "loss_fns", "ntest_per_batch"))
+def _evaluate_discrete_tasks(flat_params, apply_fn, X_test, y_test, loss_fns,
+                             i, ntest_per_batch, loss_args=None):
+    """Evaluate each loss on the overall, current and first task test sets.
+
+    The logits are computed once on the full test set and the per-example
+    losses are averaged under masks selecting each subset. Each entry of
+    `loss_fns` is a (name, loss_fn, root) triple; if `root` is set, the square
+    root of the masked mean is reported (e.g. an RMSE from per-example squared
+    errors). If given, `loss_args` holds one tuple of extra (traced) arguments
+    per loss, e.g. the observation scale of `nll_reg`, so that they do not
+    have to be bound into the static loss functions. Shapes do not depend on
+    the task index `i`, so a single compilation serves every task.
+    """
+    prev_test_batch, curr_test_batch = i*ntest_per_batch, (i+1)*ntest_per_batch
+    ix = jnp.arange(X_test.shape[0])
+    masks = {
+        "overall": ix < curr_test_batch,
+        "current": (ix >= prev_test_batch) & (ix < curr_test_batch),
+        "task1": ix < ntest_per_batch,
+    }
+    logits = _forward(flat_params, apply_fn, X_test)
+    
+    if loss_args is None:
+        loss_args = ((),) * len(loss_fns)
+    
+    result = {}
+    for (name, loss_fn, root), args in zip(loss_fns, loss_args):
+        # Losses may return one value per output (e.g. nll_binary); average
+        # them per example so that the (N,) masks select whole examples.
+        in_axes = (0, 0) + (None,) * len(args)
+        per_example = vmap(loss_fn, in_axes)(logits, y_test, *args)
+        per_example = per_example.reshape(X_test.shape[0], -1).mean(axis=-1)
+        result[name] = {
+            subset: jnp.where(mask, per_example, 0.0).sum() / mask.sum()
+            for subset, mask in masks.items()
+        }
+        if root:
+            result[name] = jax.tree_map(jnp.sqrt, result[name])
+    
+    return result
+
+
 # ------------------------------------------------------------------------------
 # Regression
 
-def cb_clf_sup(bel, pred_obs, t, X, y, bel_pred, apply_fn, lagn=20, store_fro=True, **kwargs):
+@jax.jit
+def _kernel_fro_norms(params):
+    """Frobenius norm of every "kernel" leaf of `params`, as one reduction."""
+    kernels = jax.tree_map(lambda A: A["kernel"], params, is_leaf=lambda k: "kernel" in k)
+    leaves, treedef = jax.tree_util.tree_flatten(kernels)
+    norms = jnp.sqrt(jnp.stack([jnp.vdot(A, A) for A in leaves]))
+    
+    return jax.tree_util.tree_unflatten(treedef, list(norms))
+
+
+def make_kernel_slices(recfn, flat_params):
+    """
+    Locate every "kernel" leaf of `recfn(flat_params)` in the flat parameter
+    vector, for `recfn(w) = unflatten_fn(w * scaling)` with `unflatten_fn`
+    from `ravel_pytree` (e.g. `get_mlp_flattened_params`, with or without
+    `rescale`). Returns a (hashable) pair of the kernels' treedef and their
+    static (start, stop, scale) entries, to be passed to `cb_clf_sup` as
+    `kernel_slices`.
+    """
+    # ravel_pytree concatenates the leaves in tree-flatten order
+    leaves, treedef = jax.tree_util.tree_flatten(recfn(flat_params))
+    stops = np.cumsum([A.size for A in leaves])
+    starts = stops - np.array([A.size for A in leaves])
+    leaf_ix = jax.tree_util.tree_unflatten(treedef, list(range(len(leaves))))
+    kernels = jax.tree_map(
+        lambda A: A["kernel"], leaf_ix,
+        is_leaf=lambda k: isinstance(k, Mapping) and "kernel" in k
+    )
+    kernel_ix, kernel_treedef = jax.tree_util.tree_flatten(kernels)
+    
+    # Factor by which recfn scales each entry (all ones without rescaling)
+    scales, _ = jax.tree_util.tree_flatten(recfn(jnp.ones_like(flat_params)))
+    slices = []
+    for i in kernel_ix:
+        scale = np.asarray(scales[i]).ravel()
+        if not np.allclose(scale, scale[0]):
+            raise ValueError("recfn must scale each kernel by a single factor")
+        slices.append((int(starts[i]), int(stops[i]), float(scale[0])))
+    
+    return kernel_treedef, tuple(slices)
+
+
+def _flat_kernel_fro_norms(flat_params, kernel_slices):
+    """Kernel Frobenius norms read directly off the flat parameter vector."""
+    treedef, slices = kernel_slices
+    sq = flat_params ** 2
+    norms = [abs(scale) * jnp.sqrt(sq[start:stop].sum()) for start, stop, scale in slices]
+    
+    return jax.tree_util.tree_unflatten(treedef, norms)
+
+
+def cb_clf_sup(bel, pred_obs, t, X, y, bel_pred, apply_fn, lagn=20, store_fro=True,
+               store_phat=False, **kwargs):
     """
     Callback for a classification task with a supervised loss function.
+    The one-step-ahead predicted probabilities are only returned (as "phat")
+    if `store_phat` is True. If `kernel_slices` (see `make_kernel_slices`) is
+    given, the kernel norms are computed without unflattening `bel.mean`.
     """
     X_test, y_test = kwargs["X_test"], kwargs["y_test"]
     recfn = kwargs["recfn"]
 
-    slice_ix = jnp.arange(0, lagn) + t
+    # The next lagn test points; the start is clamped so that the slice stays
+    # in range (the last lagn points are reused near the end of the data).
+    X_test = jax.lax.dynamic_slice_in_dim(X_test, t, lagn, axis=0)
+    y_test = jax.lax.dynamic_slice_in_dim(y_test, t, lagn, axis=0)
+    # Targets may be one-hot encoded (lagn, n_classes)
+    if y_test.ndim > 1:
+        y_test = y_test.reshape(lagn, -1).argmax(axis=-1)
 
-    X_test = jnp.take(X_test, slice_ix, axis=0, fill_value=0)
-    y_test = jnp.take(y_test, slice_ix, axis=0, fill_value=0)
+    y_next = y.reshape(-1).argmax(axis=-1)
+    yhat_next = pred_obs.reshape(-1).argmax(axis=-1)
 
-    y_next = y.squeeze().argmax()
-    phat_next = pred_obs.squeeze()
-    yhat_next = phat_next.argmax()
-
-    yhat_test = apply_fn(bel.mean, X_test).squeeze().argmax()
+    yhat_test = _forward(bel.mean, apply_fn, X_test).argmax(axis=-1)
 
     # Compute errors
-    err_test = (y_test == yhat_test).mean()
-    err = (y_next == yhat_next).mean()
+    err_test = jnp.sum(y_test == yhat_test) * (1.0 / lagn)
+    err = (y_next == yhat_next).astype(jnp.float32)
 
-    if store_fro:
-        mean_params = recfn(bel.mean)
-        params_magnitude = jax.tree_map(lambda A: A["kernel"], mean_params, is_leaf=lambda k: "kernel" in k)
-        params_magnitude = jax.tree_map(lambda A: jnp.linalg.norm(A, ord="fro"), params_magnitude)
+    if store_fro and kwargs.get("kernel_slices") is not None:
+        params_magnitude = _flat_kernel_fro_norms(bel.mean, kwargs["kernel_slices"])
+    elif store_fro:
+        params_magnitude = _kernel_fro_norms(recfn(bel.mean))
     else:
         params_magnitude = None
 
@@ -114,9 +321,10 @@ def cb_clf_sup(bel, pred_obs, t, X, y, bel_pred, apply_fn, lagn=20, store_fro=Tr
         "n-step-pred": yhat_test,
         "nsa-error": err_test,
         "osa-error": err,
-        "phat": phat_next,
         "params_magnitude": params_magnitude
     }
+    if store_phat:
+        res["phat"] = pred_obs.squeeze()
     return res
 
 
@@ -124,14 +332,13 @@ def cb_reg_mc_window(bel, pred_obs, t, X, y, bel_pred, apply_fn, steps=200,
                      temperature=1.0, linearize=False, aleatoric_factor=1.0,
                      **kwargs):
     agent, X_test, y_test = kwargs["agent"], kwargs["X_test"], kwargs["y_test"]
-    slice_ix = jnp.arange(0, steps) + t - steps // 2
-    X_window = jnp.take(X_test, slice_ix, axis=0, mode="clip")
-    y_window = jnp.take(y_test, slice_ix, axis=0, mode="clip")
+    X_window, y_window = _window(X_test, t, steps), _window(y_test, t, steps)
     if linearize:
         lpd = agent.evaluate_log_prob(bel_pred, X_window, y_window, aleatoric_factor)
         nlpd = -lpd.mean()
     else:
-        nlpd = agent.nlpd_mc(bel_pred, X_window, y_window, temperature=temperature)
+        nlpd = agent.nlpd_mc(bel_pred, _step_key(t, kwargs), X_window, y_window,
+                             temperature=temperature)
         nlpd = nlpd.mean()
     nlpd = {
         "nlpd": nlpd
@@ -140,25 +347,39 @@ def cb_reg_mc_window(bel, pred_obs, t, X, y, bel_pred, apply_fn, steps=200,
     return nlpd
 
 
+def _compute_yhat_test(apply_fn, flat_params, X_test):
+    """Normalised predictions of the model on the full test set."""
+    return _forward(flat_params, apply_fn, X_test).squeeze()
+
+
+@_jit_callback
 def cb_reg_sup(bel, pred_obs, t, X, y, bel_pred, apply_fn, ymean, ystd, steps=200, 
-               only_window_eval=False, **kwargs):
+               only_window_eval=False, yhat_test=None, y_test_denorm=None, **kwargs):
     """
     Callback for a regression task with a supervised loss function.
+    If given, `yhat_test` are the (normalised) predictions of `bel_pred.mean`
+    on `X_test`, e.g. shared with another callback, and `y_test_denorm` are
+    the de-normalised test targets (see `make_cb_reg_sup`).
     """
     X_test, y_test = kwargs["X_test"], kwargs["y_test"]
     
-    slice_ix = jnp.arange(0, steps) + t - steps // 2
-    
     if only_window_eval:
-        X_window = jnp.take(X_test, slice_ix, axis=0, mode="clip")
-        y_window = jnp.take(y_test, slice_ix, axis=0, mode="clip")
+        # Trace-time branch: the full-test metrics are never built here, and
+        # only the window of targets is de-normalised.
+        if y_test_denorm is None:
+            y_window = _window(y_test, t, steps) * ystd + ymean
+        else:
+            y_window = _window(y_test_denorm, t, steps)
         
-        # eval on window
-        yhat_window = jax.vmap(apply_fn, (None, 0))(bel_pred.mean, X_window).squeeze()
-        y_window = y_window * ystd + ymean
+        # eval on window (sliced from the shared predictions if available)
+        if yhat_test is None:
+            X_window = _window(X_test, t, steps)
+            yhat_window = _forward(bel_pred.mean, apply_fn, X_window)
+        else:
+            yhat_window = _window(yhat_test.reshape(X_test.shape[0], -1), t, steps)
         yhat_window = yhat_window.ravel() * ystd + ymean
         
-        err_window = jnp.sqrt(jnp.power(y_window - yhat_window, 2).mean())
+        err_window = jnp.linalg.norm(y_window - yhat_window) / jnp.sqrt(steps)
         
         res_window = {
             "window-metric": err_window
@@ -167,24 +388,22 @@ def cb_reg_sup(bel, pred_obs, t, X, y, bel_pred, apply_fn, ymean, ystd, steps=20
         return res_window
 
     # eval on all tasks test set
-    yhat_test = jax.vmap(apply_fn, (None, 0))(bel_pred.mean, X_test).squeeze()
+    if y_test_denorm is None:
+        y_test_denorm = y_test * ystd + ymean
+    if yhat_test is None:
+        yhat_test = _compute_yhat_test(apply_fn, bel_pred.mean, X_test)
 
-    # De-normalise target variables
-    y_test = y_test * ystd + ymean
+    # De-normalise predictions
     yhat_test = yhat_test.ravel() * ystd + ymean
 
     y_next = y.ravel() * ystd + ymean
     yhat_next = pred_obs.ravel() * ystd + ymean
 
-    # Compute errors
-    err_test = jnp.power(y_test - yhat_test, 2)
-    err_test_window = err_test[slice_ix].mean()
-    err_test = err_test.mean()
-    err = jnp.power(y_next - yhat_next, 2).mean()
-
-    err = jnp.sqrt(err)
-    err_test = jnp.sqrt(err_test)
-    err_test_window = jnp.sqrt(err_test_window)
+    # Compute errors (RMSE as a scaled norm: one fused reduction per metric)
+    diff_test = y_test_denorm - yhat_test
+    err_test = jnp.linalg.norm(diff_test) / jnp.sqrt(diff_test.size)
+    err_test_window = jnp.linalg.norm(_window(diff_test, t, steps)) / jnp.sqrt(steps)
+    err = jnp.linalg.norm(y_next - yhat_next) / jnp.sqrt(y_next.size)
 
     res = {
         "n-step-pred": yhat_test,
@@ -196,24 +415,50 @@ def cb_reg_sup(bel, pred_obs, t, X, y, bel_pred, apply_fn, ymean, ystd, steps=20
     return res
 
 
+def make_cb_reg_sup(X_test, y_test, ymean, ystd, steps=200, only_window_eval=False):
+    """
+    Bind the test set to `cb_reg_sup`, de-normalising the targets once here
+    instead of at every step.
+    """
+    y_test_denorm = y_test * ystd + ymean
+    callback = partial(
+        cb_reg_sup, X_test=X_test, y_test=y_test, ymean=ymean, ystd=ystd,
+        steps=steps, only_window_eval=only_window_eval, y_test_denorm=y_test_denorm,
+    )
+    
+    return callback
+
+
+@_jit_callback
 def cb_reg_mc(bel, pred_obs, t, X, y, bel_pred, apply_fn, steps=200, **kwargs):
     agent = kwargs["agent"]
     scale = kwargs["scale"]
     X_test, y_test = kwargs["X_test"], kwargs["y_test"]
-    key = jax.random.fold_in(kwargs["key"], t)
-    slice_ix = jnp.arange(0, steps) + t - steps // 2
-    mean_test = apply_fn(bel_pred.mean, X_test).squeeze()
-    nll = -distrax.Normal(pred_obs, scale).log_prob(y.ravel())
-    nll_test = -distrax.Normal(mean_test, scale).log_prob(y_test.ravel())
-    nll_window = nll_test[slice_ix].mean()
+    key = _step_key(t, kwargs)
+    yhat_test = _compute_yhat_test(apply_fn, bel_pred.mean, X_test)
+
+    # Evaluate the one-step-ahead observation and the test set as one batch
+    # [X; X_test] and split the per-example results at n_osa. The window
+    # metrics are a contiguous dynamic slice of the test part (see `_window`):
+    # no window inputs are gathered and nlpd_mc never runs on them separately.
+    n_osa = pred_obs.size
+    y_all = jnp.concatenate([y.ravel(), y_test.ravel()])
+    nll_all = _gauss_nll(
+        jnp.concatenate([pred_obs.ravel(), yhat_test.ravel()]), y_all, scale
+    )
+    nll, nll_test = nll_all[:n_osa], nll_all[n_osa:]
+    nll_window = _window(nll_test, t, steps).mean()
     nll_test = nll_test.mean()
 
-    nlpd = agent.nlpd_mc(bel_pred, key, X, y).mean()
-    nlpd_test = agent.nlpd_mc(bel_pred, key, X_test, y_test[:, None]).mean()
-    nlpd_window = agent.nlpd_mc(bel_pred, key, X_test[slice_ix], y_test[slice_ix][:, None]).mean()
+    X_all = jnp.concatenate([jnp.atleast_2d(X), X_test], axis=0)
+    nlpd_all = agent.nlpd_mc(bel_pred, key, X_all, y_all[:, None]).mean(axis=0)
+    nlpd, nlpd_test = nlpd_all[:n_osa].mean(), nlpd_all[n_osa:]
+    nlpd_window = _window(nlpd_test, t, steps).mean()
+    nlpd_test = nlpd_test.mean()
 
     res = cb_reg_sup(
-        bel, pred_obs, t, X, y, bel_pred, apply_fn, **kwargs
+        bel, pred_obs, t, X, y, bel_pred, apply_fn=apply_fn, steps=steps,
+        yhat_test=yhat_test, **kwargs
     )
 
     res = {
@@ -234,7 +479,7 @@ def cb_reg_nlpd_mc(bel, pred_obs, t, X, y, bel_pred, nan_val=-1e8,
                    temperature=1.0, linearize=False, aleatoric_factor=1.0, **kwargs):
     X_test, y_test, apply_fn, agent = \
         kwargs["X_test"], kwargs["y_test"], kwargs["apply_fn"], kwargs["agent"]
-    key = jax.random.fold_in(kwargs["key"], t)
+    key = _step_key(t, kwargs)
     if linearize:
         lpd = agent.evaluate_log_prob(bel_pred, X_test[:, jnp.newaxis, :], 
                                        y_test, aleatoric_factor).mean()
@@ -251,75 +496,65 @@ def cb_reg_nlpd_mc(bel, pred_obs, t, X, y, bel_pred, nan_val=-1e8,
 
 def cb_reg_discrete_tasks(bel, pred_obs, t, x, y, bel_pred, i, scale,
                           nll_loss_fn=None, rmse_loss_fn=None, **kwargs):
+    # The scale is passed to nll_reg as a traced argument, so that changing
+    # it does not change the static losses of the evaluator.
     if nll_loss_fn is None:
-        nll_loss_fn = lambda pred_obs, y: nll_reg(pred_obs, y, scale).mean()
+        nll_loss, nll_args = ("nll", nll_reg, False), (scale,)
+    else:
+        nll_loss, nll_args = ("nll", nll_loss_fn, False), ()
+    # By default the RMSE is the root of the mean squared error over each
+    # subset; a custom `rmse_loss_fn` is averaged per example as given.
     if rmse_loss_fn is None:
-        rmse_loss_fn = rmse_reg
-    
-    nll_evaluate_fn = partial(
-        evaluate_function,
-        loss_fn=nll_loss_fn,
-    )
-    rmse_evaluate_fn = partial(
-        evaluate_function,
-        loss_fn=rmse_loss_fn,
-    )
+        rmse_loss = ("rmse", _sq_err_reg, True)
+    else:
+        rmse_loss = ("rmse", rmse_loss_fn, False)
     
     X_test, y_test, apply_fn = kwargs["X_test"], kwargs["y_test"], kwargs["apply_fn"]
     ntest_per_batch = kwargs["ntest_per_batch"]
     
-    prev_test_batch, curr_test_batch = i*ntest_per_batch, (i+1)*ntest_per_batch
-    curr_X_test, curr_y_test = \
-        X_test[prev_test_batch:curr_test_batch], y_test[prev_test_batch:curr_test_batch]
-    cum_X_test, cum_y_test = X_test[:curr_test_batch], y_test[:curr_test_batch]
-    
-    overall_nll_result = nll_evaluate_fn(bel.mean, apply_fn, cum_X_test, cum_y_test, label="overall")
-    current_nll_result = nll_evaluate_fn(bel.mean, apply_fn, curr_X_test, curr_y_test, label="current")
-    task1_nll_result = nll_evaluate_fn(bel.mean, apply_fn, X_test[:ntest_per_batch], y_test[:ntest_per_batch],
-                                       label="task1")
-        
-    nll_result = {**overall_nll_result, **current_nll_result, **task1_nll_result,}
-    
-    overall_rmse_result = rmse_evaluate_fn(bel.mean, apply_fn, cum_X_test, cum_y_test, label="overall")
-    current_rmse_result = rmse_evaluate_fn(bel.mean, apply_fn, curr_X_test, curr_y_test, label="current")
-    task1_rmse_result = rmse_evaluate_fn(bel.mean, apply_fn, X_test[:ntest_per_batch], y_test[:ntest_per_batch],
-                                           label="task1")
-    rmse_result = {**overall_rmse_result, **current_rmse_result, **task1_rmse_result,}
-    
-    result = {
-        "nll": nll_result,
-        "rmse": rmse_result
-    }
+    result = _evaluate_discrete_tasks(
+        bel.mean, apply_fn, X_test, y_test, (nll_loss, rmse_loss), i,
+        ntest_per_batch, loss_args=(nll_args, ())
+    )
     
     return result
 
 
+def make_cb_reg_discrete_tasks(scale, nll_loss_fn=None, rmse_loss_fn=None):
+    """
+    Bind `scale` and the loss functions to `cb_reg_discrete_tasks` once per
+    run, e.g. to pass it as the "test" callback of an experiment driver.
+    """
+    callback = partial(
+        cb_reg_discrete_tasks, scale=scale, nll_loss_fn=nll_loss_fn,
+        rmse_loss_fn=rmse_loss_fn,
+    )
+    
+    return callback
+
+
 # Evaluation functions
-ll_reg = lambda pred_obs, y, scale: distrax.Normal(pred_obs, scale).log_prob(y).mean()
-nll_reg = lambda pred_obs, y, scale: -ll_reg(pred_obs, y, scale)
-generate_ll_reg_eval_fn = lambda scale: \
-    partial(evaluate_function, label="ll", loss_fn=partial(ll_reg, scale=scale))
-generate_nll_reg_eval_fn = lambda scale: \
-    partial(evaluate_function, label="nll", loss_fn=partial(nll_reg, scale=scale))
-rmse_reg = lambda pred_obs, y: jnp.sqrt(jnp.mean(jnp.power(pred_obs - y, 2)))
+_HALF_LOG_2PI = 0.5 * math.log(2 * math.pi)
+
+
+def _gauss_nll(mu, y, scale):
+    """Closed-form Gaussian negative log-density, elementwise."""
+    z = (y - mu) / scale
+    return 0.5 * z * z + jnp.log(scale) + _HALF_LOG_2PI
+
+
+nll_reg = lambda pred_obs, y, scale: _gauss_nll(pred_obs, y, scale).mean()
+ll_reg = lambda pred_obs, y, scale: -nll_reg(pred_obs, y, scale)
+_sq_err_reg = lambda pred_obs, y: jnp.mean(jnp.power(pred_obs - y, 2))
+rmse_reg = lambda pred_obs, y: jnp.sqrt(_sq_err_reg(pred_obs, y))
 nrmse_reg = lambda pred_obs, y: -rmse_reg(pred_obs, y)
-rmse_reg_eval_fn = partial(evaluate_function, label="rmse", loss_fn=rmse_reg)
-nrmse_reg_eval_fn = partial(evaluate_function, label="nrmse", loss_fn=nrmse_reg)
 
-def reg_eval_fn(flat_params, apply_fn, X_test, y_test, scale):
-    nll = generate_nll_reg_eval_fn(scale)(flat_params, apply_fn, X_test, y_test)
-    rmse = rmse_reg_eval_fn(flat_params, apply_fn, X_test, y_test)
-    result = {**nll, **rmse}
-    
-    return result
 
 # ------------------------------------------------------------------------------
 # Classification
 
 
-def clf_linearized_llfn(x, y, bel, agent, apply_fn, cooling_factor, int_labels=True):
-    logits = apply_fn(bel.mean, x)
-    cov = agent.predict_obs_cov(bel, x, aleatoric_factor=0.0, apply_fn=apply_fn)
+def _probit_adjusted_ll(logits, cov, y, cooling_factor, int_labels=True):
     logits_adj = logits / jnp.sqrt(1 + jnp.pi * jnp.diag(cov) / 8)
     prob = jax.nn.softmax(logits_adj * cooling_factor)
     if int_labels:
@@ -331,71 +566,73 @@ def clf_linearized_llfn(x, y, bel, agent, apply_fn, cooling_factor, int_labels=T
     return result
 
 
+def clf_linearized_llfn(x, y, bel, agent, apply_fn, cooling_factor, int_labels=True):
+    logits = apply_fn(bel.mean, x)
+    cov = agent.predict_obs_cov(bel, x, aleatoric_factor=0.0, apply_fn=apply_fn)
+    result = _probit_adjusted_ll(logits, cov, y, cooling_factor, int_labels)
+    
+    return result
+
+
+def clf_linearized_llfn_batch(X, Y, bel, agent, apply_fn, cooling_factor, int_labels=True):
+    """
+    Batched `clf_linearized_llfn`: the logits and predictive covariances are
+    computed for all of `X` under one transformation each.
+    """
+    logits = vmap(apply_fn, (None, 0))(bel.mean, X).reshape(X.shape[0], -1)
+    covs = agent.predict_obs_cov_batched(bel, X, aleatoric_factor=0.0, apply_fn=apply_fn)
+    covs = covs.reshape(X.shape[0], *covs.shape[-2:])
+    result = vmap(_probit_adjusted_ll, (0, 0, 0, None, None))(
+        logits, covs, Y, cooling_factor, int_labels
+    )
+    
+    return result
+
+
+_nll_softmax_il = lambda logits, label: \
+    optax.softmax_cross_entropy_with_integer_labels(logits, label).mean()
+_miscl_softmax = lambda logits, label: jnp.mean(logits.argmax(axis=-1) != label)
+
+
+@partial(jax.jit, static_argnames=("apply_fn",))
+def _clf_eval_both(flat_params, apply_fn, X, y):
+    """Mean softmax NLL and misclassification rate from one forward pass."""
+    logits = _forward(flat_params, apply_fn, X)
+    nll = optax.softmax_cross_entropy_with_integer_labels(logits, y).mean()
+    miscl = (logits.argmax(axis=-1) != y).mean()
+    
+    return {"nll": nll, "miscl": miscl}
+
+
 def cb_clf_discrete_tasks(bel, pred_obs, t, x, y, bel_pred, i,
                           nll_loss_fn=None, miscl_loss_fn=None, **kwargs):
     if nll_loss_fn is None:
-        nll_loss_fn = lambda logits, label: \
-            optax.softmax_cross_entropy_with_integer_labels(logits, label).mean()
+        nll_loss_fn = _nll_softmax_il
     if miscl_loss_fn is None:
-        miscl_loss_fn = lambda logits, label: jnp.mean(logits.argmax(axis=-1) != label)
-    
-    nll_evaluate_fn = partial(
-        evaluate_function,
-        loss_fn=nll_loss_fn,
-    )
-    miscl_evaluate_fn = partial(
-        evaluate_function,
-        loss_fn=miscl_loss_fn,
-    )
+        miscl_loss_fn = _miscl_softmax
     
     X_test, y_test, apply_fn = kwargs["X_test"], kwargs["y_test"], kwargs["apply_fn"]
     ntest_per_batch = kwargs["ntest_per_batch"]
     
-    prev_test_batch, curr_test_batch = i*ntest_per_batch, (i+1)*ntest_per_batch
-    curr_X_test, curr_y_test = \
-        X_test[prev_test_batch:curr_test_batch], y_test[prev_test_batch:curr_test_batch]
-    cum_X_test, cum_y_test = X_test[:curr_test_batch], y_test[:curr_test_batch]
-    
-    overall_nll_result = nll_evaluate_fn(bel.mean, apply_fn, cum_X_test, cum_y_test, label="overall")
-    current_nll_result = nll_evaluate_fn(bel.mean, apply_fn, curr_X_test, curr_y_test, label="current")
-    task1_nll_result = nll_evaluate_fn(bel.mean, apply_fn, X_test[:ntest_per_batch], y_test[:ntest_per_batch],
-                                       label="task1")
-        
-    nll_result = {**overall_nll_result, **current_nll_result, **task1_nll_result,}
-    
-    overall_miscl_result = miscl_evaluate_fn(bel.mean, apply_fn, cum_X_test, cum_y_test, label="overall")
-    current_miscl_result = miscl_evaluate_fn(bel.mean, apply_fn, curr_X_test, curr_y_test, label="current")
-    task1_miscl_result = miscl_evaluate_fn(bel.mean, apply_fn, X_test[:ntest_per_batch], y_test[:ntest_per_batch],
-                                           label="task1")
-    miscl_result = {**overall_miscl_result, **current_miscl_result, **task1_miscl_result,}
-    
-    result = {
-        "nll": nll_result,
-        "miscl": miscl_result
-    }
+    result = _evaluate_discrete_tasks(
+        bel.mean, apply_fn, X_test, y_test,
+        (("nll", nll_loss_fn, False), ("miscl", miscl_loss_fn, False)), i, ntest_per_batch
+    )
     
     return result
 
 
+@_jit_callback
 def cb_clf_window_test(bel, pred_obs, t, X, y, bel_pred, steps=200, **kwargs):
-    nll_loss_fn = lambda logits, label: \
-        optax.softmax_cross_entropy_with_integer_labels(logits, label).mean()
-    miscl_loss_fn = lambda logits, label: jnp.mean(logits.argmax(axis=-1) != label)
-    
     X_test, y_test, apply_fn = kwargs["X_test"], kwargs["y_test"], kwargs["apply_fn"]
-    slice_ix = jnp.arange(0, steps) + t - steps // 2
-    X_window, y_window = jnp.take(X_test, slice_ix, axis=0, mode="clip"), \
-        jnp.take(y_test, slice_ix, axis=0, mode="clip")
+    X_window, y_window = _window(X_test, t, steps), _window(y_test, t, steps)
     
     # Eval on window
-    nll_evaluate_fn = partial(evaluate_function, loss_fn=nll_loss_fn)
-    miscl_evalute_fn = partial(evaluate_function, loss_fn=miscl_loss_fn)
-    window_nll_result = nll_evaluate_fn(bel.mean, apply_fn, X_window, y_window, label="window-nll")
-    window_miscl_result = miscl_evalute_fn(bel.mean, apply_fn, X_window, y_window, label="window-miscl")
+    window_result = _clf_eval_both(bel.mean, apply_fn, X_window, y_window)
     
     result = {
-        **window_nll_result,
-        **window_miscl_result,
+        "window-nll": window_result["nll"],
+        "window-miscl": window_result["miscl"],
     }
     
     return result
@@ -403,14 +640,23 @@ def cb_clf_window_test(bel, pred_obs, t, X, y, bel_pred, steps=200, **kwargs):
 
 def cb_clf_nlpd_mc(bel, pred_obs, t, X, y, bel_pred, nan_val=-1e8,
                    temperature=1.0, linearize=False, cooling_factor=1.0,
-                   int_labels=False, **kwargs):
-    X_test, y_test, apply_fn, agent = \
-        kwargs["X_test"][:100], kwargs["y_test"][:100], kwargs["apply_fn"], kwargs["agent"]
-    key = jax.random.fold_in(kwargs["key"], t)
+                   int_labels=False, nlpd_eval_n=100, **kwargs):
+    """
+    NLPD on the first `nlpd_eval_n` test points (all of them if None).
+    `nlpd_eval_n` is a Python int, so the slice is fixed at trace time; to
+    avoid it altogether, pass an already truncated test set with
+    `nlpd_eval_n=None`.
+    """
+    X_test, y_test = kwargs["X_test"], kwargs["y_test"]
+    if nlpd_eval_n is not None:
+        X_test, y_test = X_test[:nlpd_eval_n], y_test[:nlpd_eval_n]
+    apply_fn, agent = kwargs["apply_fn"], kwargs["agent"]
+    key = _step_key(t, kwargs)
     if linearize:
-        llfn = partial(clf_linearized_llfn, bel=bel_pred, agent=agent,
-                       apply_fn=apply_fn, cooling_factor=cooling_factor)
-        lpd = vmap(llfn)(X_test[:, jnp.newaxis, :], y_test)
+        lpd = clf_linearized_llfn_batch(
+            X_test[:, jnp.newaxis, :], y_test, bel=bel_pred, agent=agent,
+            apply_fn=apply_fn, cooling_factor=cooling_factor
+        )
         nlpd = -lpd.mean()
     else:
         nlpd = agent.nlpd_mc(bel, key, X_test[:, jnp.newaxis, :], y_test,
@@ -427,16 +673,16 @@ def cb_clf_mc_window(bel, pred_obs, t, X, y, bel_pred, apply_fn, steps=100,
                      temperature=1.0, linearize=False, cooling_factor=1.0,
                      **kwargs):
     agent, X_test, y_test = kwargs["agent"], kwargs["X_test"], kwargs["y_test"]
-    slice_ix = jnp.arange(0, steps) + t - steps // 2
-    X_window = jnp.take(X_test, slice_ix, axis=0, mode="clip")
-    y_window = jnp.take(y_test, slice_ix, axis=0, mode="clip")
+    X_window, y_window = _window(X_test, t, steps), _window(y_test, t, steps)
     if linearize:
-        llfn = partial(clf_linearized_llfn, bel=bel_pred, agent=agent,
-                       apply_fn=apply_fn, cooling_factor=cooling_factor)
-        lpd = vmap(llfn)(X_window, y_window)
+        lpd = clf_linearized_llfn_batch(
+            X_window, y_window, bel=bel_pred, agent=agent, apply_fn=apply_fn,
+            cooling_factor=cooling_factor
+        )
         nlpd = -lpd.mean()
     else:
-        nlpd = agent.nlpd_mc(bel_pred, X_window, y_window, temperature=temperature)
+        nlpd = agent.nlpd_mc(bel_pred, _step_key(t, kwargs), X_window, y_window,
+                             temperature=temperature)
         nlpd = nlpd.mean()
     nlpd = {
         "nlpd": nlpd
@@ -450,22 +696,73 @@ nll_softmax = lambda logits, labels, int_labels: \
     optax.softmax_cross_entropy_with_integer_labels(logits, labels) if int_labels \
     else optax.softmax_cross_entropy(logits, labels)
 ll_softmax = lambda logits, labels, int_labels: -nll_softmax(logits, labels, int_labels)
-softmax_ll_il_clf_eval_fn = partial(evaluate_function, label="ll",
-                                    loss_fn=partial(ll_softmax, int_labels=True),)
-softmax_nll_il_clf_eval_fn = partial(evaluate_function, label="nll",
-                                     loss_fn=partial(nll_softmax, int_labels=True))
 
 miscl_softmax = lambda logits, labels: \
     (logits.argmax(axis=-1) != labels).mean()
-softmax_miscl_clf_eval_fn = partial(evaluate_function, loss_fn=miscl_softmax, label="miscl")
+nll_binary = lambda logits, labels: optax.sigmoid_binary_cross_entropy(logits, labels)
+ll_binary = lambda logits, labels: -nll_binary(logits, labels)
+miscl_binary = lambda logits, labels: jnp.mean((logits > 0.0) != labels)
 
-def softmax_clf_eval_fn(flat_params, apply_fn, X_test, y_test):
-    nll = softmax_nll_il_clf_eval_fn(flat_params, apply_fn, X_test, y_test)
-    miscl = softmax_miscl_clf_eval_fn(flat_params, apply_fn, X_test, y_test)
-    result = {**nll, **miscl}
+
+# ------------------------------------------------------------------------------
+# Compiled evaluation
+
+# Every entry takes (logits, labels, scale), where `scale` is only used by the
+# Gaussian regression losses. All eval fns below share a single jitted kernel
+# that selects its losses by (static) index into this table.
+_LOSS_TABLE = (
+    ("ll_reg", ll_reg),
+    ("nll_reg", nll_reg),
+    ("rmse_reg", lambda pred_obs, y, scale: rmse_reg(pred_obs, y)),
+    ("nrmse_reg", lambda pred_obs, y, scale: nrmse_reg(pred_obs, y)),
+    ("ll_softmax_il", lambda logits, labels, scale: ll_softmax(logits, labels, True)),
+    ("nll_softmax_il", lambda logits, labels, scale: nll_softmax(logits, labels, True)),
+    ("miscl_softmax", lambda logits, labels, scale: miscl_softmax(logits, labels)),
+)
+_LOSS_IDS = {name: ix for ix, (name, _) in enumerate(_LOSS_TABLE)}
+
+
+@partial(jax.jit, static_argnames=("apply_fn", "loss_ids", "nan_val", "dtype"))
+def _eval_core(flat_params, apply_fn, X_test, y_test, scale, loss_ids, nan_val=None,
+               dtype=None):
+    logits = _match_targets(_forward(flat_params, apply_fn, X_test, dtype), y_test)
+    result = tuple(
+        _nan_guard(_LOSS_TABLE[loss_id][1](logits, y_test, scale).mean(), nan_val)
+        for loss_id in loss_ids
+    )
     
     return result
 
-nll_binary = lambda logits, labels: optax.sigmoid_binary_cross_entropy(logits, labels)
-ll_binary = lambda logits, labels: -nll_binary(logits, labels)
-miscl_binary = lambda logits, labels: jnp.mean((logits > 0.0) != labels)
\ No newline at end of file
+
+def _make_eval_fn(losses, scale=1.0, dtype=None):
+    """
+    Build an eval fn returning {label: mean loss} for each (label, loss name)
+    pair in `losses`, computed from a single forward pass in `dtype`.
+    """
+    labels = tuple(label for label, _ in losses)
+    loss_ids = tuple(_LOSS_IDS[name] for _, name in losses)
+    def eval_fn(flat_params, apply_fn, X_test, y_test, nan_val=None):
+        evals = _eval_core(flat_params, apply_fn, X_test, y_test, scale, loss_ids,
+                           nan_val, dtype)
+        return dict(zip(labels, evals))
+    
+    return eval_fn
+
+
+generate_ll_reg_eval_fn = lambda scale, dtype=None: \
+    _make_eval_fn((("ll", "ll_reg"),), scale, dtype)
+generate_nll_reg_eval_fn = lambda scale, dtype=None: \
+    _make_eval_fn((("nll", "nll_reg"),), scale, dtype)
+rmse_reg_eval_fn = _make_eval_fn((("rmse", "rmse_reg"),))
+nrmse_reg_eval_fn = _make_eval_fn((("nrmse", "nrmse_reg"),))
+
+def reg_eval_fn(flat_params, apply_fn, X_test, y_test, scale, nan_val=None, dtype=None):
+    eval_fn = _make_eval_fn((("nll", "nll_reg"), ("rmse", "rmse_reg")), scale, dtype)
+    result = eval_fn(flat_params, apply_fn, X_test, y_test, nan_val)
+    
+    return result
+
+softmax_ll_il_clf_eval_fn = _make_eval_fn((("ll", "ll_softmax_il"),))
+softmax_nll_il_clf_eval_fn = _make_eval_fn((("nll", "nll_softmax_il"),))
+softmax_miscl_clf_eval_fn = _make_eval_fn((("miscl", "miscl_softmax"),))
+softmax_clf_eval_fn = _make_eval_fn((("nll", "nll_softmax_il"), ("miscl", "miscl_softmax")))
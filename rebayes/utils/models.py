@@ -4,7 +4,6 @@ from typing import Callable, Sequence
 import flax.linen as nn
 import jax
 from jax import jacrev, jit
-from jax.experimental import host_callback
 from jax.flatten_util import ravel_pytree
 import jax.numpy as jnp
 import jax.random as jr
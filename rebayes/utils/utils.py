@@ -1,10 +1,8 @@
-from functools import partial
 from typing import Sequence
 
 import flax.linen as nn
 import jax
 from jax import jacrev, jit
-from jax.experimental import host_callback
 from jax.flatten_util import ravel_pytree
 import jax.numpy as jnp
 import jax.random as jr
@@ -63,13 +61,11 @@ def scaling_factor(model_dims, bias_weight_cov_ratio):
     biases = features[1:]
     fan_ins = features[:-1]
     num_kernels = features[:-1] * features[1:]
-    bias_fanin_kernels = zip(biases, fan_ins, num_kernels)
-    factors = []
-    for term in bias_fanin_kernels:
-        bias, fan_in, num_kernel = (x.item() for x in term)
-        factors.extend([1.0] * bias)
-        factors.extend([bias_weight_cov_ratio/np.sqrt(fan_in)] * num_kernel)
-    factors = np.array(factors).ravel()
+    # Per layer: `bias` ones followed by `num_kernel` copies of the kernel scale
+    kernel_scales = bias_weight_cov_ratio / np.sqrt(fan_ins)
+    values = np.stack([np.ones_like(kernel_scales), kernel_scales], axis=1).ravel()
+    counts = np.stack([biases, num_kernels], axis=1).ravel()
+    factors = np.repeat(values, counts)
 
     return factors    
 
@@ -104,9 +100,12 @@ def get_mlp_flattened_params(model_dims, key=0, activation=nn.relu, rescale=Fals
     params = model.init(key, dummy_input)
     flat_params, unflatten_fn = ravel_pytree(params)
     
-    scaling = scaling_factor(model_dims, bias_weight_cov_ratio) if rescale else 1.0
-    flat_params = flat_params / scaling
-    rec_fn = lambda x: unflatten_fn(x * scaling)
+    if rescale:
+        scaling = scaling_factor(model_dims, bias_weight_cov_ratio)
+        flat_params = flat_params / scaling
+        rec_fn = lambda x: unflatten_fn(x * scaling)
+    else:
+        rec_fn = unflatten_fn
     
     # Define apply function
     @jit
@@ -150,19 +149,22 @@ def init_model(key=0, type='cnn', features=(400, 400, 10), classification=True,
             # Binary classification
             sigmoid_fn = lambda w, x: jnp.clip(jax.nn.sigmoid(apply_fn(w, x)), 1e-4, 1-1e-4).ravel()
             emission_mean_function = lambda w, x: sigmoid_fn(w, x)
-            emission_cov_function = lambda w, x: sigmoid_fn(w, x) * (1 - sigmoid_fn(w, x))
+            bernoulli_cov = lambda p: p * (1 - p)
+            emission_cov_function = lambda w, x: bernoulli_cov(sigmoid_fn(w, x))
         else:
             # Multiclass classification
             emission_mean_function=lambda w, x: jax.nn.softmax(apply_fn(w, x))
-            def emission_cov_function(w, x):
-                ps = emission_mean_function(w, x)
+            def categorical_cov(ps):
                 return jnp.diag(ps) - jnp.outer(ps, ps) + 1e-3 * jnp.eye(len(ps)) # Add diagonal to avoid singularity
             
+            def emission_cov_function(w, x):
+                return categorical_cov(emission_mean_function(w, x))
+            
             def replay_emission_cov_function(w, w_lin, x):
                 m_Y = lambda w: emission_mean_function(w, x)
                 H = _jacrev_2d(m_Y, w_lin)
                 ps = jnp.atleast_1d(m_Y(w_lin)) + H @ (w - w_lin)
-                return jnp.diag(ps) - jnp.outer(ps, ps) + 1e-3 * jnp.eye(len(ps)) # Add diagonal to avoid singularity
+                return categorical_cov(ps)
             model_dict["replay_emission_cov_function"] = replay_emission_cov_function
         model_dict['emission_mean_function'] = emission_mean_function
         model_dict['emission_cov_function'] = emission_cov_function
@@ -199,25 +201,27 @@ def initialize_params(flat_params, predict_fn):
 
 def fit_optax(params, optimizer, input, output, loss_fn, num_epochs, return_history=False):
     opt_state = optimizer.init(params)
+    input, output = jnp.asarray(input), jnp.asarray(output)
 
-    @jax.jit
-    def step(params, opt_state, x, y):
+    def step(carry, xy):
+        params, opt_state = carry
+        x, y = xy
         loss_value, grads = jax.value_and_grad(loss_fn)(params, x, y)
         updates, opt_state = optimizer.update(grads, opt_state, params)
         params = optax.apply_updates(params, updates)
-        return params, opt_state, loss_value
+        return (params, opt_state), (params if return_history else loss_value)
 
-    if return_history:
-        params_history=[]
+    def epoch(carry, _):
+        return jax.lax.scan(step, carry, (input, output))
 
-    for epoch in range(num_epochs):
-        for i, (x, y) in enumerate(zip(input, output)):
-            params, opt_state, loss_value = step(params, opt_state, x, y)
-            if return_history:
-                params_history.append(params)
+    # A single compiled scan over epochs and (inner) over examples
+    (params, _), history = jit(
+        lambda carry: jax.lax.scan(epoch, carry, None, length=num_epochs)
+    )((params, opt_state))
 
     if return_history:
-        return jnp.array(params_history)
+        # (num_epochs, n_steps, ...) -> (num_epochs * n_steps, ...)
+        return jax.tree_map(lambda h: h.reshape(-1, *h.shape[2:]), history)
     return params
 
 
@@ -246,11 +250,9 @@ def eval_runs(key, num_runs_pc, agent, model, train, test, eval_callback, test_k
 
     num_devices = jax.device_count()
     num_sims = num_runs_pc * num_devices
-    keys = jax.random.split(key, num_sims).reshape(-1, num_devices, 2)
+    keys = jax.random.split(key, num_sims)
     n_vals = len(X_learn)
 
-    @partial(jax.pmap, in_axes=1)
-    @partial(jax.vmap, in_axes=0)
     def evalf(key):
         key_shuffle, key_init = jax.random.split(key)
         ixs_shuffle = jax.random.choice(key_shuffle, n_vals, (n_vals,), replace=False)
@@ -263,7 +265,13 @@ def eval_runs(key, num_runs_pc, agent, model, train, test, eval_callback, test_k
         )
 
         return output
-    outputs = evalf(keys)
+
+    if num_devices == 1:
+        # No device axis: skip pmap's replication and transfer overhead.
+        outputs = jax.jit(jax.vmap(evalf))(keys)
+    else:
+        keys = keys.reshape(-1, num_devices, 2)
+        outputs = jax.pmap(jax.vmap(evalf), in_axes=1)(keys)
     outputs = jax.tree_map(lambda x: x.reshape(num_sims, -1), outputs)
     
     return outputs
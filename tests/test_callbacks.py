@@ -0,0 +1,154 @@
+import pytest
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+import jax.random as jr
+
+from rebayes.utils.callbacks import (
+    _flat_kernel_fro_norms,
+    _forward,
+    _evaluate_discrete_tasks,
+    _kernel_fro_norms,
+    _window,
+    cb_clf_discrete_tasks,
+    cb_clf_sup,
+    cb_eval,
+    cb_reg_discrete_tasks,
+    make_kernel_slices,
+    nll_binary,
+    nll_reg,
+)
+from rebayes.base import Belief
+from rebayes.utils.utils import get_mlp_flattened_params
+
+
+@pytest.mark.parametrize("rescale", [False, True])
+def test_flat_kernel_fro_norms(rescale):
+    _, flat_params, recfn, _ = get_mlp_flattened_params([4, 8, 3], rescale=rescale)
+    flat_params = flat_params + jr.normal(jr.PRNGKey(0), flat_params.shape)
+    kernel_slices = make_kernel_slices(recfn, flat_params)
+    
+    for start, stop, _ in kernel_slices[1]:
+        assert 0 <= start < stop <= flat_params.size
+    
+    norms_flat = _flat_kernel_fro_norms(flat_params, kernel_slices)
+    norms_tree = _kernel_fro_norms(recfn(flat_params))
+    
+    assert jax.tree_util.tree_structure(norms_flat) == \
+        jax.tree_util.tree_structure(norms_tree)
+    assert jnp.allclose(
+        jnp.array(jax.tree_util.tree_leaves(norms_flat)),
+        jnp.array(jax.tree_util.tree_leaves(norms_tree)),
+        rtol=1e-5,
+    )
+
+
+def test_reg_discrete_tasks_rmse():
+    _, flat_params, _, apply_fn = get_mlp_flattened_params([2, 4, 1])
+    ntest_per_batch, i = 5, 1
+    X_test = jr.normal(jr.PRNGKey(0), (3 * ntest_per_batch, 2))
+    y_test = jr.normal(jr.PRNGKey(1), (3 * ntest_per_batch, 1))
+    bel = Belief(mean=flat_params, obs_noise_var=1.0)
+    
+    result = cb_reg_discrete_tasks(
+        bel, None, 0, None, None, None, i, 1.0,
+        X_test=X_test, y_test=y_test, apply_fn=apply_fn,
+        ntest_per_batch=ntest_per_batch,
+    )
+    
+    err = _forward(flat_params, apply_fn, X_test) - y_test
+    rmse = lambda e: jnp.sqrt(jnp.mean(e ** 2))
+    assert jnp.allclose(result["rmse"]["overall"], rmse(err[:10]))
+    assert jnp.allclose(result["rmse"]["current"], rmse(err[5:10]))
+    assert jnp.allclose(result["rmse"]["task1"], rmse(err[:5]))
+
+
+def test_clf_discrete_tasks_per_output_loss():
+    # nll_binary returns one value per output, i.e. (N, 1) over the test set.
+    _, flat_params, _, apply_fn = get_mlp_flattened_params([2, 4, 1])
+    ntest_per_batch, i = 5, 1
+    X_test = jr.normal(jr.PRNGKey(0), (3 * ntest_per_batch, 2))
+    y_test = jr.bernoulli(jr.PRNGKey(1), shape=(3 * ntest_per_batch, 1)) * 1.0
+    bel = Belief(mean=flat_params, obs_noise_var=1.0)
+    
+    result = cb_clf_discrete_tasks(
+        bel, None, 0, None, None, None, i, nll_loss_fn=nll_binary,
+        X_test=X_test, y_test=y_test, apply_fn=apply_fn,
+        ntest_per_batch=ntest_per_batch,
+    )
+    
+    nll = nll_binary(_forward(flat_params, apply_fn, X_test), y_test)
+    assert jnp.allclose(result["nll"]["overall"], nll[:10].mean())
+    assert jnp.allclose(result["nll"]["current"], nll[5:10].mean())
+    assert jnp.allclose(result["nll"]["task1"], nll[:5].mean())
+
+
+def test_clf_sup_one_hot_targets():
+    _, flat_params, recfn, apply_fn = get_mlp_flattened_params([2, 4, 3])
+    X_test = jr.normal(jr.PRNGKey(0), (30, 2))
+    labels = jr.randint(jr.PRNGKey(1), (30,), 0, 3)
+    bel = Belief(mean=flat_params, obs_noise_var=1.0)
+    y, pred_obs = jax.nn.one_hot(labels[0], 3), jnp.array([0.2, 0.5, 0.3])
+    callback = partial(
+        cb_clf_sup, bel, pred_obs, 4, X_test[0], y, bel, apply_fn, lagn=20,
+        X_test=X_test, recfn=recfn,
+    )
+    
+    res_int = callback(y_test=labels)
+    res_one_hot = callback(y_test=jax.nn.one_hot(labels, 3))
+    
+    yhat_test = _forward(flat_params, apply_fn, X_test[4:24]).argmax(axis=-1)
+    assert jnp.allclose(res_int["nsa-error"], (labels[4:24] == yhat_test).mean())
+    assert jnp.allclose(res_one_hot["nsa-error"], res_int["nsa-error"])
+
+
+@pytest.mark.parametrize("t", [0, 3, 250, 497, 499])
+def test_window(t):
+    A = jnp.arange(500)
+    window = _window(A, t, 10)
+    start = min(max(t - 5, 0), 490)
+    
+    assert jnp.array_equal(window, A[start:start + 10])
+
+
+def test_window_short_array():
+    A = jnp.arange(6)
+    window = _window(A, 1, 10)
+    
+    assert jnp.array_equal(window, jnp.array([0, 0, 0, 0, 0, 1, 2, 3, 4, 5]))
+
+
+def test_cb_eval_plain_evaluate_fn():
+    # evaluate_fn needs no nan_val keyword; cb_eval replaces NaNs itself.
+    _, flat_params, _, apply_fn = get_mlp_flattened_params([2, 4, 1])
+    X_test = jr.normal(jr.PRNGKey(0), (10, 2))
+    bel = Belief(mean=flat_params, obs_noise_var=1.0)
+    evaluate_fn = lambda w, apply_fn, X, y: {"loss": jnp.log(-1.0 + 0 * y.sum())}
+    
+    res = cb_eval(
+        bel, None, 0, None, None, None, evaluate_fn=evaluate_fn, nan_val=-5.0,
+        X_test=X_test, y_test=jnp.zeros(10), apply_fn=apply_fn,
+    )
+    
+    assert res["loss"] == -5.0
+
+
+def test_reg_discrete_tasks_scale_is_traced():
+    _, flat_params, _, apply_fn = get_mlp_flattened_params([2, 4, 1])
+    X_test = jr.normal(jr.PRNGKey(0), (10, 2))
+    y_test = jr.normal(jr.PRNGKey(1), (10, 1))
+    bel = Belief(mean=flat_params, obs_noise_var=1.0)
+    callback = partial(
+        cb_reg_discrete_tasks, bel, None, 0, None, None, None, 0,
+        X_test=X_test, y_test=y_test, apply_fn=apply_fn, ntest_per_batch=5,
+    )
+    
+    callback(scale=1.0)
+    cache_size = _evaluate_discrete_tasks._cache_size()
+    result = callback(scale=2.0)
+    
+    assert _evaluate_discrete_tasks._cache_size() == cache_size
+    logits = _forward(flat_params, apply_fn, X_test)
+    nll = nll_reg(logits[:5], y_test[:5], 2.0)
+    assert jnp.allclose(result["nll"]["task1"], nll)
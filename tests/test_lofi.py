@@ -17,10 +17,27 @@ from rebayes.utils.utils import get_mlp_flattened_params
 RebayesLoFiEstimators = [RebayesLoFiOrthogonal, RebayesLoFiSpherical, RebayesLoFiDiagonal]
 
 
-def setup_lofi(memory_size, steady_state, inflation_type, estimator_class):
+@pytest.fixture(scope="module")
+def rmnist():
+    # Load rotated MNIST dataset once for all parametrized cases
+    n_train = 200
+    X_train, y_train = rotating_permuted_mnist_data.generate_rotating_mnist_dataset()
+    
+    return X_train[:n_train], y_train[:n_train]
+
+
+@pytest.fixture(scope="module")
+def mlp():
+    # Share one apply_fn so that cases with equal settings hit the same traces
     input_dim, hidden_dims, output_dim = 784, [2, 2], 1
     model_dims = [input_dim, *hidden_dims, output_dim]
     _, flat_params, _, apply_fn = get_mlp_flattened_params(model_dims)
+    
+    return flat_params, apply_fn
+
+
+def setup_lofi(mlp, memory_size, steady_state, inflation_type, estimator_class):
+    flat_params, apply_fn = mlp
     initial_mean, initial_covariance = flat_params, 1e-1
     estimator = estimator_class(
         dynamics_weights=1.0,
@@ -51,11 +68,8 @@ def test_fast_svd():
     "memory_size, steady_state, inflation_type, estimator_class",
     [(10, ss, it, ec) for ss in [True, False] for it in INFLATION_METHODS for ec in RebayesLoFiEstimators]
 )
-def test_lofi(memory_size, steady_state, inflation_type, estimator_class):
-    # Load rotated MNIST dataset
-    n_train = 200
-    X_train, y_train = rotating_permuted_mnist_data.generate_rotating_mnist_dataset()
-    X_train, y_train = X_train[:n_train], y_train[:n_train]
+def test_lofi(rmnist, mlp, memory_size, steady_state, inflation_type, estimator_class):
+    X_train, y_train = rmnist
     
     # Define mean callback function
     def callback(bel, *args, **kwargs):
@@ -63,7 +77,7 @@ def test_lofi(memory_size, steady_state, inflation_type, estimator_class):
     
     # Test if run without error
     initial_mean, initial_cov, lofi_estimator = \
-        setup_lofi(memory_size, steady_state, inflation_type, estimator_class)
+        setup_lofi(mlp, memory_size, steady_state, inflation_type, estimator_class)
         
     _ = lofi_estimator.scan(initial_mean, initial_cov, X_train, y_train, callback)
     
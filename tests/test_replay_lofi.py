@@ -0,0 +1,220 @@
+import pytest
+
+import jax
+import jax.numpy as jnp
+import jax.random as jr
+
+from rebayes.low_rank_filter.replay_lofi import (
+    MVN,
+    ReplayLoFiParams,
+    RebayesReplayLoFiDiagonal,
+)
+from rebayes.utils.callbacks import cb_reg_mc
+from rebayes.utils.utils import get_mlp_flattened_params
+
+
+BUFFER_SIZE = 3
+
+
+def allclose(u, v, atol=1e-4):
+    return jax.tree_util.tree_all(
+        jax.tree_map(lambda a, b: jnp.allclose(a, b, atol=atol), u, v)
+    )
+
+
+@pytest.fixture(scope="module")
+def regression_data():
+    n_train = 12
+    key1, key2 = jr.split(jr.PRNGKey(0))
+    X = jr.normal(key1, (n_train, 2))
+    y = jnp.sin(X[:, :1]) + 0.1 * jr.normal(key2, (n_train, 1))
+
+    return X, y
+
+
+@pytest.fixture(scope="module")
+def mlp():
+    _, flat_params, _, apply_fn = get_mlp_flattened_params([2, 4, 1])
+
+    return flat_params, apply_fn
+
+
+def setup_replay_lofi(mlp, buffer_size=BUFFER_SIZE, **kwargs):
+    flat_params, apply_fn = mlp
+    params = ReplayLoFiParams(
+        buffer_size=buffer_size,
+        dim_input=2,
+        dim_output=1,
+        initial_mean=flat_params,
+        initial_covariance=1.0,
+        dynamics_weights=1.0,
+        dynamics_covariance=1e-4,
+        emission_mean_function=apply_fn,
+        emission_cov_function=lambda w, w_lin, x: 0.1 * jnp.eye(1),
+        memory_size=2,
+        **kwargs,
+    )
+
+    return RebayesReplayLoFiDiagonal(params)
+
+
+def mean_callback(bel, *args, **kwargs):
+    return bel.mean
+
+
+def test_update_state_matches_scan(regression_data, mlp):
+    X, y = regression_data
+    estimator = setup_replay_lofi(mlp)
+    bel_scan, _ = estimator.scan(X, y)
+
+    bel = estimator.init_bel()
+    for x_t, y_t in zip(X, y):
+        bel = estimator.update_state(estimator.predict_state(bel), x_t, y_t)
+
+    assert allclose(bel.mean, bel_scan.mean)
+    assert allclose(bel.Ups, bel_scan.Ups)
+
+
+def test_circular_buffer(regression_data, mlp):
+    # Reading the circular buffers from the head gives the old shift layout:
+    # the last buffer_size observations, oldest first.
+    X, y = regression_data
+    estimator = setup_replay_lofi(mlp)
+    bel, _ = estimator.scan(X, y)
+
+    unroll = lambda buffer: jnp.roll(buffer, -bel.head, axis=0)
+    assert jnp.allclose(unroll(bel.buffer_X), X[-BUFFER_SIZE:])
+    assert jnp.allclose(unroll(bel.buffer_y), y[-BUFFER_SIZE:])
+    assert jnp.allclose(unroll(bel.buffer_mean)[-1], bel.mean)
+
+
+def test_linearize_once(regression_data, mlp):
+    X, y = regression_data
+    bel, _ = setup_replay_lofi(mlp).scan(X, y)
+    bel_once, _ = setup_replay_lofi(mlp, linearize_once=True).scan(X, y)
+
+    assert allclose(bel.mean, bel_once.mean)
+    assert allclose(bel.basis, bel_once.basis)
+
+
+def test_parallel_replay(regression_data, mlp):
+    # With a single buffered observation, the batched replay update is the
+    # sequential one.
+    X, y = regression_data
+    bel, _ = setup_replay_lofi(mlp, buffer_size=1).scan(X, y)
+    bel_par, _ = setup_replay_lofi(mlp, buffer_size=1, parallel_replay=True).scan(X, y)
+    assert allclose(bel.mean, bel_par.mean)
+
+    bel_par, _ = setup_replay_lofi(mlp, parallel_replay=True).scan(X, y)
+    assert jnp.all(jnp.isfinite(bel_par.mean))
+
+
+def test_compute_dtype(regression_data, mlp):
+    X, y = regression_data
+    bel, _ = setup_replay_lofi(mlp).scan(X, y)
+    bel_f32, _ = setup_replay_lofi(mlp, compute_dtype=jnp.float32).scan(X, y)
+    assert allclose(bel.mean, bel_f32.mean)
+
+    # bfloat16 rounding accumulates over steps; compare a short run only.
+    bel, _ = setup_replay_lofi(mlp).scan(X[:4], y[:4])
+    bel_bf16, _ = setup_replay_lofi(mlp, compute_dtype=jnp.bfloat16).scan(X[:4], y[:4])
+    assert bel_bf16.mean.dtype == bel.mean.dtype
+    assert allclose(bel.mean, bel_bf16.mean, atol=1e-1)
+
+
+def test_max_ntime(regression_data, mlp):
+    X, y = regression_data
+    bel, outputs = setup_replay_lofi(mlp).scan(X, y, callback=mean_callback)
+    bel_pad, outputs_pad = setup_replay_lofi(mlp, max_ntime=20).scan(
+        X, y, callback=mean_callback
+    )
+
+    assert outputs_pad.shape == outputs.shape
+    assert allclose(outputs, outputs_pad)
+    assert allclose(bel.mean, bel_pad.mean)
+
+
+def test_max_ntime_reuses_compilation(regression_data, mlp):
+    X, y = regression_data
+    estimator = setup_replay_lofi(mlp, max_ntime=20)
+    for n_steps in [X.shape[0], 8]:
+        bel, outputs = setup_replay_lofi(mlp).scan(
+            X[:n_steps], y[:n_steps], callback=mean_callback
+        )
+        bel_pad, outputs_pad = estimator.scan(
+            X[:n_steps], y[:n_steps], callback=mean_callback
+        )
+        assert allclose(outputs, outputs_pad)
+        assert allclose(bel.mean, bel_pad.mean)
+
+    jitted_scan, = estimator._jitted_scans.values()
+    assert jitted_scan._cache_size() == 1
+
+
+def test_compile_cache(regression_data, mlp):
+    X, y = regression_data
+    bel, outputs = setup_replay_lofi(mlp).scan(X, y, callback=mean_callback)
+    estimator = setup_replay_lofi(mlp, compile_cache=True)
+    for _ in range(2):
+        bel_cached, outputs_cached = estimator.scan(X, y, callback=mean_callback)
+        assert allclose(outputs, outputs_cached)
+        assert allclose(bel.mean, bel_cached.mean)
+    assert len(estimator._compiled_scans) == 1
+
+
+def test_compile_cache_static_kwargs(regression_data, mlp):
+    # Non-array callback kwargs are constants of the compiled scan.
+    X, y = regression_data
+    estimator = setup_replay_lofi(mlp, compile_cache=True)
+    callback = lambda bel, *args, agent, key_t, **kwargs: \
+        agent.predict_obs(bel, X[0])
+    _, outputs = estimator.scan(
+        X, y, callback=callback, agent=estimator, key=jr.PRNGKey(0)
+    )
+
+    assert outputs.shape == (X.shape[0], 1)
+
+
+def test_nlpd_mc_emission_dist(regression_data, mlp):
+    # The default and a user-supplied emission_dist both get the covariance.
+    X, y = regression_data
+    estimator = setup_replay_lofi(mlp)
+    bel, _ = estimator.scan(X, y)
+    custom_dist = lambda mean, cov: MVN(loc=mean, scale_tril=jnp.linalg.cholesky(cov))
+    estimator_custom = setup_replay_lofi(mlp, emission_dist=custom_dist)
+
+    key = jr.PRNGKey(1)
+    nlpd = estimator.nlpd_mc(bel, key, X, y)
+    nlpd_custom = estimator_custom.nlpd_mc(bel, key, X, y)
+
+    assert nlpd.shape == (30, X.shape[0])
+    assert allclose(nlpd, nlpd_custom)
+
+
+def test_fixed_signature_callback(regression_data, mlp):
+    # key_t is only passed to callbacks that accept it.
+    X, y = regression_data
+    def callback(bel, pred_obs, t, x, y, bel_pred, key):
+        return jr.normal(key)
+    
+    _, outputs = setup_replay_lofi(mlp).scan(X, y, callback=callback, key=jr.PRNGKey(0))
+    
+    assert outputs.shape == (X.shape[0],)
+
+
+def test_cb_reg_mc(regression_data, mlp):
+    # nlpd_mc follows the base (bel, key, ...) -> (n_samples, ntime) contract.
+    X, y = regression_data
+    _, apply_fn = mlp
+    estimator = setup_replay_lofi(mlp)
+    bel, _ = estimator.scan(X, y)
+    pred_obs = estimator.predict_obs(bel, X[0])
+
+    res = cb_reg_mc(
+        bel, pred_obs, 3, X[0], y[0], bel, apply_fn=apply_fn, steps=4, agent=estimator,
+        scale=jnp.sqrt(0.1), X_test=X, y_test=y.ravel(), ymean=0.0, ystd=1.0,
+        key=jr.PRNGKey(0),
+    )
+    nlpd = estimator.nlpd_mc(bel, jr.fold_in(jr.PRNGKey(0), 3), X, y).mean(axis=0)
+
+    assert jnp.allclose(res["nlpd_test"], nlpd.mean(), atol=1e-4)